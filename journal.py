@@ -0,0 +1,68 @@
+"""A persistent record of which units of work have been completed, so that an
+interrupted backfill can pick up where it left off.
+
+A unit is identified by (stage, source, season, week, division, date), where
+division and date may be None for units that cover a whole week, and week may
+be None for units that don't belong to one week (NCAA pages, which are
+fetched by date). Stages are
+'fetched' (one source/division/date scraped and cached), 'staged' (a source's
+games loaded for matching), 'matched' and 'uploaded'."""
+
+import datetime
+
+import model
+
+STAGES = ['fetched', 'staged', 'matched', 'uploaded']
+
+def _week(week):
+    """Returns the week as stored in the journal."""
+    return None if week is None else str(week)
+
+def _query(session, stage, source, season, week, division, date):
+    """Returns a query for the journal entry of a single unit."""
+    if isinstance(date, datetime.datetime):
+        date = date.date()
+    return session.query(model.JournalEntry).filter(
+        model.JournalEntry.stage == stage,
+        model.JournalEntry.source == source,
+        model.JournalEntry.seasonyear == int(season),
+        model.JournalEntry.week == _week(week),
+        model.JournalEntry.division == division,
+        model.JournalEntry.date == date)
+
+def get_entry(session, stage, source, season, week, division=None, date=None):
+    """Returns the model.JournalEntry for the unit, or None if it hasn't been
+    completed."""
+    return _query(session, stage, source, season, week, division, date).first()
+
+def is_done(session, stage, source, season, week, division=None, date=None):
+    """Returns True if the unit has been completed."""
+    return get_entry(session, stage, source, season, week, division, date) is not None
+
+def mark_done(session, stage, source, season, week, division=None, date=None, rows=None):
+    """Records that the unit has been completed and commits the session.
+    
+    rows - optionally, the number of games in the unit"""
+    if stage not in STAGES:
+        raise ValueError("Unknown stage '{}'".format(stage))
+    entry = get_entry(session, stage, source, season, week, division, date)
+    if entry is None:
+        if isinstance(date, datetime.datetime):
+            date = date.date()
+        entry = model.JournalEntry(stage=stage, source=source, seasonyear=int(season),
+                                   week=_week(week), division=division, date=date)
+        session.add(entry)
+    entry.rows = rows
+    entry.completed = datetime.datetime.now()
+    session.commit()
+    return entry
+
+def forget(session, season, week, stages=STAGES):
+    """Removes all journal entries for the given week and stages, so that they
+    will be redone. Commits the session."""
+    session.query(model.JournalEntry).filter(
+        model.JournalEntry.seasonyear == int(season),
+        model.JournalEntry.week == str(week),
+        model.JournalEntry.stage.in_(stages)
+    ).delete(synchronize_session=False)
+    session.commit()
@@ -1,135 +1,181 @@
-import ncaa
-import espn
-import model
+"""Command line interface for fetching, matching and uploading a week of games.
+
+    python main.py fetch SEASON WEEK     scrape (or read cached) games from each source
+    python main.py match SEASON WEEK     validate and stage the games, match the sources
+    python main.py upload SEASON WEEK    upload matched games, writing a review file
+    python main.py run [SEASON WEEK]     match and upload (the default command)
+    python main.py report DATE [DATE]    show the games in the database on those dates
+    python main.py schedule TEAM [SEASON] show a team's games (--opponent for head to head)
+    python main.py reindex               rebuild the team schedule index
+    python main.py status SEASON [WEEK]  show the journal for a season or week
+    python main.py export --since SEQ    write games changed after SEQ as NDJSON
+    python main.py daemon                fetch, match and upload on a schedule
+
+WEEK is 1-15 or B for bowls. Games come from ESPN and NCAA by default; use
+--source to pick other registered sources (see sources.py). Heavy
+dependencies (selenium, pandas, bs4) are only imported by the commands that
+need them, so report and status start quickly. The read-only commands
+(report, schedule, status and export) never create tables, so they work for
+database users without DDL rights; the others create any that are missing.
+"""
 
-import pandas
-import sqlalchemy
+import argparse
+import datetime
 import os
+import socket
 import sys
-import datetime
 
-dbfile = 'sqlite:///cfb.sqlite3'
-cachedir = 'cache'
+import db
+import journal
+import model
+import sources
 
-# Which week do we want?
-# Future update: take command line arguments?
-season = None
-while season is None:
-    try:
-        season = int(input("Please enter a season : "))
-    except:
-        season = None
-week = None
-while week is None:
-    week = input("Please enter a week (1-15,B) : ")
-    if week in map(str, range(1,16)):
-        week = int(week)
-    elif str(week).lower() in ['b', 'bowl']:
-        week = 'Bowl'
-    else:
-        week = None
-
-# Get the games, checking for cached copies
-def get_games(season, week, cachedir='cache', echo=True):
-    # ESPN
-    espnfilename = "ESPN-{}-{}.csv".format(season, week)
-    if os.path.exists(os.path.join(cachedir, espnfilename)):
-        if echo:
-            print("Reading cached ESPN games...", end=" ", flush=True)
-        espngames = pandas.read_csv(os.path.join(cachedir, espnfilename),
-                                    parse_dates=['Date'])
-    else:
-        if echo:
-            print("Fetching ESPN games...", end=" ", flush=True)
-        espngames = espn.get_week_games(season, week)
-        os.makedirs(cachedir, exist_ok=True)
-        espngames.to_csv(os.path.join(cachedir, espnfilename), index=False)
-    if echo:
-        print(len(espngames), "games.")
-    # NCAA
-    ncaafilename = "NCAA-{}-{}.csv".format(season, week)
-    if os.path.exists(os.path.join(cachedir, ncaafilename)):
-        if echo:
-            print("Reading cached NCAA games...", end=" ", flush=True)
-        ncaagames = pandas.read_csv(os.path.join(cachedir, ncaafilename),
-                                    parse_dates=['Date'])
-    else:
-        if echo:
-            print("Fetching NCAA games...", end=" ", flush=True)
-        ncaagamelist = []
-        for d in list(set(espngames['Date'])):
-            ncaagamelist.append(ncaa.get_date_games(season,d))
-        ncaagames = pandas.concat(ncaagamelist).reset_index(drop=True)
-        os.makedirs(cachedir, exist_ok=True)
-        ncaagames.to_csv(os.path.join(cachedir, ncaafilename), index=False)
-    if echo:
-        print(len(ncaagames), "games.")
-    # Return them both
-    return espngames, ncaagames
-
-# Flush/Fill the match table in the given session
-def create_matches(session):
+DEFAULT_CACHEDIR = 'cache'
+DEFAULT_WORKERS = 3
+
+# Identifies this process in job leases
+JOB_OWNER = '{}:{}'.format(socket.gethostname(), os.getpid())
+# Jobs whose lease hasn't been renewed for this long are stale
+JOB_LEASE = datetime.timedelta(hours=1)
+
+# Get the games from each source, in order. Each source caches and journals
+# what it fetches, so only what's missing is fetched. Returns a dictionary of
+# datasource: pandas DataFrame.
+def get_games(season, week, session, srcs, cachedir='cache', echo=True, workers=1):
+    games = {}
+    dates = None
+    for source in srcs:
+        games[source.name] = source.fetch(season, week, session, cachedir, dates=dates,
+                                          echo=echo, workers=workers)
+        # Later sources look for games on the dates found so far
+        found = {d.date() for df in games.values() if 'Date' in df for d in df['Date']}
+        dates = sorted(found) if dates is None else sorted(found | set(dates))
+    return games
+
+# Fill the match table for the given job, in one statement
+def create_matches(session, job):
+    lease_job(session, job)
     # Delete any existing matches
-    for m in session.query(model.Match):
-        session.delete(m)
+    session.query(model.Match).filter(model.Match.jobid == job.id).delete(
+            synchronize_session=False)
     # Create new matches
-    for row in session.execute(model.match_query):
-        session.add(model.Match(espngameid=row['espngameid'], ncaagameid=row['ncaagameid']))
+    session.execute(model.Match.__table__.insert().from_select(
+            ['stagedgameid', 'jobid', 'date', 'hometeamid', 'awayteamid', 'team1id', 'team2id'],
+            model.match_query(job.id)))
     # Commit the changes
     session.commit()
 
-# Load games into temporary tables in model for analysis
-def load_games(espndf, ncaadf, session):
-    # ESPN games
-    for r in espndf.to_dict('records'):
-        game = model.TempESPNGame(away=r['Away'],
-                                  home=r['Home'],
-                                  date=r['Date'],
-                                  awaypoints=r['AwayPoints'],
-                                  homepoints=r['HomePoints'],
-                                  seasonyear=r['Season'],
-                                  comments=r['Comments'],
-                                  overtimes=r['Overtimes'])
-        session.add(game)
-    # NCAA games
-    for r in ncaadf.to_dict('records'):
-        game = model.TempNCAAGame(away=r['Away'],
-                                  home=r['Home'],
-                                  date=r['Date'],
-                                  awaypoints=r['AwayPoints'],
-                                  homepoints=r['HomePoints'],
-                                  seasonyear=r['Season'],
-                                  comments=r['Comments'],
-                                  neutralsite=r['NeutralSite'])
-        session.add(game)
-    # Commit these inserts
+# Delete a job and everything staged for it
+def drop_job(session, job):
+    for cls in [model.Match, model.StagedGame]:
+        session.query(cls).filter(cls.jobid == job.id).delete(synchronize_session=False)
+    session.delete(job)
     session.commit()
-    # Now create matches
-    create_matches(session)
-    # Query and return the results
-    return session.query(model.TempESPNGame), session.query(model.TempNCAAGame)
 
+# Take (or renew) the lease on a job, so other workers leave it alone
+def lease_job(session, job):
+    if job.lease is None:
+        job.lease = model.JobLease(owner=JOB_OWNER)
+    job.lease.owner = JOB_OWNER
+    job.lease.renewed = datetime.datetime.now()
+    session.commit()
 
-# Get the games
-print()
-espndf, ncaadf = get_games(season, week, cachedir=cachedir, echo=True)
+# Is the job ours, or left behind by a worker which stopped using it?
+def job_is_free(job):
+    return (job.lease is None or job.lease.owner == JOB_OWNER
+            or datetime.datetime.now() - job.lease.renewed > JOB_LEASE)
 
-# Create engine/connection/session
-engine = sqlalchemy.create_engine(dbfile)
-dbcon = engine.connect()
-model.Base.metadata.create_all(dbcon)  # create temp tables
-session = model.Session(bind=dbcon)
+# Find the job with this week's staged games, or start a new one. Returns the
+# job and whether it was resumed. Jobs leased by other workers are never
+# resumed or dropped.
+def get_job(session, season, week, names):
+    jobs = session.query(model.Job).filter(model.Job.seasonyear == season,
+                                           model.Job.week == str(week)
+                                          ).order_by(model.Job.id.desc()).all()
+    staged = all(journal.is_done(session, 'staged', name, season, week) for name in names)
+    if staged and len(jobs) > 0 and job_is_free(jobs[0]):
+        lease_job(session, jobs[0])
+        return jobs[0], True
+    # Start over, clearing anything we (or a stale worker) partially staged before
+    for job in jobs:
+        if job_is_free(job):
+            drop_job(session, job)
+    journal.forget(session, season, week, ['staged', 'matched'])
+    job = model.Job(seasonyear=season, week=str(week))
+    session.add(job)
+    lease_job(session, job)
+    return job, False
 
-# Load the games into the db
-espngames, ncaagames = load_games(espndf, ncaadf, session)
+# Query the staged games of a job from one source
+def staged_games(session, job, datasource):
+    return session.query(model.StagedGame).filter(model.StagedGame.jobid == job.id,
+                                                  model.StagedGame.datasource == datasource)
 
-# How many games are already in the database?
-print("Games already existing for these dates:",
-        session.query(model.Game).filter(model.Game.date.in_({g.date for g in ncaagames})).count(),
-        "games.")
+# Load games from each source into the staging table for analysis
+def load_games(games, session, job):
+    import frames
+    for datasource, df in games.items():
+        # Only finished games can be staged. (Older caches have no Status, and
+        # only ever held finished games.)
+        if 'Status' in df:
+            df = df[df['Status'] == 'final']
+        for r in frames.records(df):
+            game = model.StagedGame(jobid=job.id,
+                                    datasource=datasource,
+                                    away=r['Away'],
+                                    home=r['Home'],
+                                    date=r['Date'],
+                                    awaypoints=r['AwayPoints'],
+                                    homepoints=r['HomePoints'],
+                                    seasonyear=r['Season'],
+                                    comments=r.get('Comments'),
+                                    overtimes=r.get('Overtimes'),
+                                    neutralsite=None if r.get('NeutralSite') is None
+                                                else bool(r['NeutralSite']))
+            session.add(game)
+    # Commit these inserts
+    session.commit()
+    # Now create matches
+    create_matches(session, job)
+
+# Run data-quality checks on scraped games, quarantining the bad rows
+def check_games(games, srcs, season, week, cachedir, severity=None):
+    import validate
+    if severity is None:
+        severity = validate.get_severity()
+    good, report = {}, []
+    for source in srcs:
+        df = games[source.name]
+        # Unfinished games are never staged, so don't complain about their scores
+        if 'Status' in df:
+            df = df[df['Status'] == 'final']
+        ok, quarantined, entries = validate.validate_games(df, season, source.name, severity)
+        good[source.name] = ok
+        report.extend(entries)
+        if len(quarantined) > 0:
+            os.makedirs(cachedir, exist_ok=True)
+            path = os.path.join(cachedir, "QUARANTINE-{}-{}-{}.csv".format(season, week, source.label))
+            quarantined.to_csv(path, index=False)
+            print("Quarantined", len(quarantined), source.label, "games, see", path)
+    return good, report
+
+# Find the latest job for a week, without starting a new one
+def find_job(session, season, week):
+    return session.query(model.Job).filter(model.Job.seasonyear == season,
+                                           model.Job.week == str(week)
+                                          ).order_by(model.Job.id.desc()).first()
 
 ################################################################################
 
+# Ask a yes or no question, unless the answer is assumed to be yes
+def confirm(question, assume_yes=False):
+    if assume_yes:
+        return True
+    answer = str(input(question + " (y/n) ")).lower()
+    while answer not in ['y','n']:
+        answer = str(input(question + " (y/n) ")).lower()
+    return answer == 'y'
+
 # Check for games with unknown team names
 def find_unknown_teams(games):
     unknown = set()
@@ -140,65 +186,27 @@ def find_unknown_teams(games):
             unknown.add(g.away)
     return list(unknown)
 
-print()
-# Display unknown ESPN Teams
-print("Unknown ESPN Teams: ", end="")
-unknown_espn_teams = find_unknown_teams(espngames)
-if len(unknown_espn_teams) > 0:
-    print(", ".join(unknown_espn_teams))
-else:
-    print("None.")
-# Loop through them and prompt for teamids
-for t in unknown_espn_teams:
-    team = None
-    while team is None:
-        id = input("Enter team id for " + t + ": ")
-        team = session.query(model.Team).filter(model.Team.id == id).one_or_none()
-        print(team)
-        if input('Correct? (y/n) ').lower() != 'y':
-            team = None
-    session.add(model.SourceTeamName(datasource='espn.com', name=t, teamid=id))
-session.commit()
-    
-# Display unknown NCAA Teams
-print("Unknown NCAA Teams: ", end="")
-unknown_ncaa_teams = find_unknown_teams(ncaagames)
-if len(unknown_ncaa_teams) > 0:
-    print(", ".join(unknown_ncaa_teams))
-else:
-    print("None.")
-# Loop through them and prompt for teamids
-for t in unknown_ncaa_teams:
-    team = None
-    while team is None:
-        id = input("Enter team id for " + t + ": ")
-        team = session.query(model.Team).filter(model.Team.id == id).one_or_none()
-        print(team)
-        if input('Correct? (y/n) ').lower() != 'y':
-            team = None
-    session.add(model.SourceTeamName(datasource='ncaa.org', name=t, teamid=id))
-session.commit()
-    
-# Create new matches and look for unknown teams again
-create_matches(session)
-unknown_espn_teams = find_unknown_teams(espngames)
-unknown_ncaa_teams = find_unknown_teams(ncaagames)
-if len(unknown_espn_teams) + len(unknown_ncaa_teams) > 0:
-    # To Do: handle this better. Perhaps prompts?
-    raise Exception('Please add entries to "sourceteamname" table for the above team(s).')
-
-################################################################################
-
-# Check for ESPN or NCAA games without matches or with more than one match
-def get_mismatch(games):
-    nomatch = []
-    multimatch = []
-    for g in games:
-        if len(g.matches) == 0:
-            nomatch.append(g)
-        elif len(g.matches) > 1:
-            multimatch.append(g)
-    return nomatch, multimatch
+# Display unknown team names, and prompt for their team ids if allowed
+def resolve_unknown_teams(session, games, datasource, label, prompt=True):
+    print("Unknown {} Teams: ".format(label), end="")
+    unknown = find_unknown_teams(games)
+    if len(unknown) > 0:
+        print(", ".join(unknown))
+    else:
+        print("None.")
+    if not prompt:
+        return
+    # Loop through them and prompt for teamids
+    for t in unknown:
+        team = None
+        while team is None:
+            id = input("Enter team id for " + t + ": ")
+            team = session.query(model.Team).filter(model.Team.id == id).one_or_none()
+            print(team)
+            if input('Correct? (y/n) ').lower() != 'y':
+                team = None
+        session.add(model.SourceTeamName(datasource=datasource, name=t, teamid=id))
+    session.commit()
 
 def print_no_score(game):
     print("{}: {}, {} ('{}') vs {} ('{}')".format(
@@ -209,60 +217,6 @@ def print_no_score(game):
         game.awayteamlink.team.shortname,
         game.away
     ))
-    
-print()
-espn_nomatch, espn_multi = get_mismatch(espngames)
-print("ESPN Games without matches: ", end="")
-if len(espn_nomatch) > 0:
-    print()
-    for g in espn_nomatch:
-        print_no_score(g)
-else:
-    print("None.")
-print("ESPN Games with more than one match: ", end="")
-if len(espn_multi) > 0:
-    print()
-    for g in espn_multi:
-        print_no_score(g)
-else:
-    print("None.")
-ncaa_nomatch, ncaa_multi = get_mismatch(ncaagames)
-print("NCAA Games without matches: ", end="")
-if len(ncaa_nomatch) > 0:
-    print()
-    for g in ncaa_nomatch:
-        print_no_score(g)
-else:
-    print("None.")
-print("NCAA Games with more than one match: ", end="")
-if len(ncaa_multi) > 0:
-    print()
-    for g in ncaa_multi:
-        print_no_score(g)
-else:
-    print("None.")
-
-# Check for games with score disagreements
-def check_scores_same(espngame, ncaagame):
-    # If home matches home, and away matches away...
-    if ((espngame.hometeamlink.teamid == ncaagame.hometeamlink.teamid)
-            and (espngame.awayteamlink.teamid == ncaagame.awayteamlink.teamid)):
-        if ((espngame.homepoints == ncaagame.homepoints) 
-                and (espngame.awaypoints == ncaagame.awaypoints)):
-            return True
-        else:
-            return False
-    # If home matches away, and away matches home (i.e. neutral site)...
-    elif ((espngame.hometeamlink.teamid == ncaagame.awayteamlink.teamid)
-            and (espngame.awayteamlink.teamid == ncaagame.hometeamlink.teamid)):
-        if ((espngame.homepoints == ncaagame.awaypoints) 
-                and (espngame.awaypoints == ncaagame.homepoints)):
-            return True
-        else:
-            return False
-    # Otherwise some error happened
-    else:
-        raise Exception('check_scores_same received unmatched games')
 
 def print_with_score(game):
     print("{}: {}, {} ('{}') vs {} ('{}'): {}-{}".format(
@@ -275,206 +229,449 @@ def print_with_score(game):
         game.homepoints,
         game.awaypoints
     ))
-    
-print()
-print("Matched games with score disagreements: ", end="")
-numdisagreements = 0
-for m in session.query(model.Match):
-    if not check_scores_same(m.espngame, m.ncaagame):
-        if numdisagreements == 0:
-            print()
-        numdisagreements += 1
-        print("ESPN ", end="")
-        print_with_score(m.espngame)
-        print("NCAA ", end="")
-        print_with_score(m.ncaagame)
-if numdisagreements == 0:
-    print("None.")
-
-################################################################################    
-
-# Create a game (model.Game and model.GameResult) from a matched pair
-def game_from_match(m):
-    # Sort out combining comments
-    comments = None
-    if (m.espngame.comments is not None) and (m.ncaagame.comments is not None):
-        comments = m.espngame.comments + ', ' + m.ncaagame.comments
-    elif m.espngame.comments is not None:
-        comments = m.espngame.comments
-    elif m.ncaagame.comments is not None:
-        comments = m.ncaagame.comments
-    # Create game, result
-    game = model.Game(date=m.espngame.date, seasonid=m.espngame.season.id,
-                      hometeamid=m.espngame.hometeamlink.teamid,
-                      awayteamid=m.espngame.awayteamlink.teamid,
-                      neutralsite=m.ncaagame.neutralsite, comments=comments)
-    if check_scores_same(m.espngame, m.ncaagame):
-        result = model.GameResult(homepoints = m.espngame.homepoints,
-                                  awaypoints = m.espngame.awaypoints,
-                                  overtimes = m.espngame.overtimes)
+
+# Print a list of games under a heading, or "None."
+def print_games(heading, games, printer=print_no_score):
+    print(heading + ": ", end="")
+    if len(games) > 0:
+        print()
+        for g in games:
+            printer(g)
     else:
-        print("Score needed for ", end="")
-        print_no_score(m.espngame)
-        homepoints = input('Home team points: ')
-        awaypoints = input('Away team points: ')
-        overtimes = input('Overtimes: ')
-        result = model.GameResult(homepoints = homepoints,
-                                  awaypoints = awaypoints,
-                                  overtimes = overtimes)
-    result.game = game
-    return game, result
-
-# Check if a model.Game already exists in the database before adding it to the session
-def game_is_duplicate(testgame, session):
-    potentialmatches = session.query(model.Game).filter(
-        sqlalchemy.or_(
-            sqlalchemy.and_(
-                model.Game.hometeamid == testgame.hometeamid, 
-                model.Game.awayteamid == testgame.awayteamid,
-                model.Game.date == testgame.date),
-            sqlalchemy.and_(
-                model.Game.hometeamid == testgame.awayteamid, 
-                model.Game.awayteamid == testgame.hometeamid,
-                model.Game.date == testgame.date,
-                testgame.neutralsite == True),
-        )
-    )
-    n = potentialmatches.count()
-    if n == 0:
-        return False
-    elif n == 1:
-        return True
+        print("None.")
+
+# Print games missing from a source or listed more than once by one, and games
+# whose sources disagree on the score
+def print_mismatches(session, job, srcs):
+    import reconcile
+    games = reconcile.find_games(session, job)
+    labels = {source.name: source.label for source in srcs}
+    print()
+    for source in srcs:
+        print_games("Games missing from " + source.label,
+                    [game[0].stagedgame for game in games
+                     if source.name not in {m.stagedgame.datasource for m in game}])
+    print_games("Games listed more than once by a source",
+                [m.stagedgame for game in games
+                 if len({m.stagedgame.datasource for m in game}) < len(game) for m in game])
+    print()
+    print("Matched games with score disagreements: ", end="")
+    numdisagreements = 0
+    for game in games:
+        if len({reconcile.oriented_points(m, game[0].hometeamid) for m in game}) > 1:
+            if numdisagreements == 0:
+                print()
+            numdisagreements += 1
+            for m in game:
+                print(labels.get(m.stagedgame.datasource, m.stagedgame.datasource) + " ", end="")
+                print_with_score(m.stagedgame)
+    if numdisagreements == 0:
+        print("None.")
+
+################################################################################
+
+def cmd_fetch(args, session):
+    """Scrapes (or reads cached) games for the week."""
+    get_games(args.season, args.week, session, sources.get_sources(args.sources),
+              cachedir=args.cachedir, echo=True, workers=args.workers)
+
+def cmd_match(args, session, games=None):
+    """Stages the week's games from each source, fixes unknown team names and
+    matches the sources' games to each other. Returns the job. games may hold
+    games already fetched (as from get_games), to save fetching them again."""
+    srcs = sources.get_sources(args.sources)
+    # Pick up this week's staged games from an interrupted run, if any
+    job, resumed = get_job(session, args.season, args.week, [s.name for s in srcs])
+    if resumed:
+        print()
+        print("Resuming games staged by job", job.id)
     else:
-        raise Exception('Duplicate games in database.')
-
-# Upload games if desired.
-print("\n")
-proceed = str(input("Upload all matched games? (y/n) ")).lower()
-while proceed not in ['y','n']:
-    proceed = str(input("Upload all matched games? (y/n) ")).lower()
-
-if proceed == 'y':
-    print("Uploading games...")
-    inserted = 0
-    duplicates = 0
-    for m in session.query(model.Match):
-        game, result = game_from_match(m)
-        if not game_is_duplicate(game, session):
-            inserted += 1
-            session.add(game)
-            session.add(result)
+        # Get the games, skipping anything the journal says was already fetched
+        print()
+        if games is None:
+            games = get_games(args.season, args.week, session, srcs, cachedir=args.cachedir,
+                              echo=True, workers=args.workers)
+        # Leave out games which fail the data-quality checks
+        import validate
+        severity = validate.get_severity(args.checks)
+        games, report = check_games(games, srcs, args.season, args.week, args.cachedir, severity)
+        # Load the games into the db
+        load_games(games, session, job)
+        report.extend(validate.validate_staged(session, job, severity))
+        os.makedirs(args.cachedir, exist_ok=True)
+        path = os.path.join(args.cachedir, "VALIDATION-{}-{}.json".format(args.season, args.week))
+        validate.write_report(path, report)
+        for entry in report:
+            print("Validation {severity}: {check} ({source}), {rows} rows".format(**entry))
+        for source in srcs:
+            journal.mark_done(session, 'staged', source.name, args.season, args.week,
+                              rows=len(games[source.name]))
+    # How many games are already in the database?
+    dates = {d for (d,) in session.query(model.StagedGame.date).filter(
+                model.StagedGame.jobid == job.id).distinct()}
+    print("Games already existing for these dates:",
+            session.query(model.Game).filter(model.Game.date.in_(dates)).count(),
+            "games.")
+    # Unknown team names
+    print()
+    for source in srcs:
+        resolve_unknown_teams(session, staged_games(session, job, source.name), source.name,
+                              source.label, prompt=not args.no_input)
+    # Create new matches and look for unknown teams again
+    create_matches(session, job)
+    journal.mark_done(session, 'matched', 'matches', args.season, args.week,
+                      rows=session.query(model.Match).filter(model.Match.jobid == job.id).count())
+    if any(len(find_unknown_teams(staged_games(session, job, source.name))) > 0 for source in srcs):
+        raise Exception('Please add entries to "sourceteamname" table for the above team(s).')
+    print_mismatches(session, job, srcs)
+    return job
+
+def cmd_upload(args, session, job=None):
+    """Applies a filled-in review file, then uploads every game resolved by
+    the reconciliation rules and writes the rest to a new review file."""
+    import reconcile
+    if job is None:
+        job = find_job(session, args.season, args.week)
+        if job is None or not journal.is_done(session, 'matched', 'matches', args.season, args.week):
+            print("No matched games for this week. Run the match command first.")
+            return 1
+    lease_job(session, job)
+    # Anything the rules can't settle goes to a review file, which is applied
+    # on the next upload.
+    reviewfile = os.path.join(args.cachedir, "REVIEW-{}-{}.csv".format(args.season, args.week))
+    # Apply a review file from a previous run, if desired.
+    keepreview = False
+    if os.path.exists(reviewfile):
+        print("\n")
+        if confirm("Apply reviewed games from " + reviewfile + "?", args.yes):
+            inserted, duplicates, skipped, pending = reconcile.apply_review(session, reviewfile, job)
+            journal.mark_done(session, 'uploaded', 'review', args.season, args.week, rows=inserted)
+            print('Newly inserted:', inserted)
+            print('Duplicates not inserted:', duplicates)
+            print('Skipped:', skipped)
+            print('Still waiting for review:', pending)
         else:
-            duplicates += 1
-        # Delete the temporary rows we used to make this game
-        session.delete(m.espngame)
-        session.delete(m.ncaagame)
-        session.delete(m)
-    session.commit()
-    print('Newly inserted:', inserted)
-    print('Duplicates not inserted:', duplicates)
+            keepreview = True
+    print("\n")
+    resolved, review = reconcile.reconcile(session, job)
+    print("Games resolved by rules:", len(resolved))
+    print("Games needing review:", len(review))
+    # Upload games if desired.
+    uploaded = len(resolved) == 0
+    if len(resolved) > 0 and confirm("Upload all resolved games?", args.yes):
+        print("Uploading games...")
+        inserted, duplicates = reconcile.upload(session, resolved)
+        journal.mark_done(session, 'uploaded', 'reconciled', args.season, args.week, rows=inserted)
+        print('Newly inserted:', inserted)
+        print('Duplicates not inserted:', duplicates)
+        uploaded = True
+    # Write the games needing review
+    if len(review) > 0:
+        if keepreview:
+            print("Not overwriting", reviewfile, "since it wasn't applied.")
+        else:
+            os.makedirs(args.cachedir, exist_ok=True)
+            reconcile.write_review(reviewfile, review)
+            print("Games needing review written to", reviewfile)
+            print("Fill in their scores, overtimes and neutral sites, set action to 'upload' or 'skip',")
+            print("then run the upload command again to apply them.")
+    # Once everything is uploaded or in the review file the job is finished.
+    # (Review rows don't refer to the job, see reconcile.apply_review.)
+    if uploaded and (len(review) == 0 or not keepreview):
+        drop_job(session, job)
+    return 0
 
-################################################################################
+def cmd_run(args, session):
+    """Matches and uploads a week, prompting for the week if not given."""
+    if args.season is None:
+        while args.season is None:
+            try:
+                args.season = int(input("Please enter a season : "))
+            except:
+                args.season = None
+    if args.week is None:
+        while args.week is None:
+            try:
+                args.week = parse_week(input("Please enter a week (1-15,B) : "))
+            except argparse.ArgumentTypeError:
+                args.week = None
+    job = cmd_match(args, session)
+    return cmd_upload(args, session, job)
 
-# Create a game from an unmatched ESPN game, prompting for info as necessary
-def game_from_espn(espn, neutralsite=None, comment='Missing from NCAA.org'):
-    # Create full comment
-    if espn.comments is not None:
-        comment = espn.comments + ', ' + comment
-    # Prompt user for neutralsite, if necessary
-    while neutralsite is None:
-        neutralsite = input('Neutral Site: (y/n) ').lower()
-        if neutralsite in ['y','n']:
-            neutralsite = (neutralsite == 'y')
+def cmd_report(args, session):
+    """Prints the games in the database on the given dates."""
+    from sqlalchemy.orm import aliased
+    hometeam = aliased(model.Team)
+    awayteam = aliased(model.Team)
+    end = args.end if args.end is not None else args.start
+    rows = session.query(model.Game, model.GameResult, hometeam.shortname, awayteam.shortname
+            ).join(hometeam, model.Game.hometeamid == hometeam.id
+            ).join(awayteam, model.Game.awayteamid == awayteam.id
+            ).outerjoin(model.GameResult, model.Game.id == model.GameResult.id
+            ).filter(model.Game.date >= args.start, model.Game.date <= end
+            ).order_by(model.Game.date, model.Game.id)
+    count = 0
+    for game, result, home, away in rows:
+        count += 1
+        line = "{}: {}, {} vs {}".format(game.id, game.date.strftime("%Y-%m-%d"), home, away)
+        if result is not None:
+            line += ": {}-{}".format(result.homepoints, result.awaypoints)
+            if result.overtimes > 0:
+                line += " ({}OT)".format(result.overtimes)
+        if game.neutralsite:
+            line += " (neutral site)"
+        print(line)
+    print(count, "games.")
+    return 0
+
+def cmd_schedule(args, session):
+    """Prints a team's games, or its games against one opponent."""
+    import pandas
+    import schedule
+    team = int(args.team) if args.team.isdigit() else args.team
+    try:
+        if args.opponent is not None:
+            opponent = int(args.opponent) if args.opponent.isdigit() else args.opponent
+            games = schedule.head_to_head(session, team, opponent)
+            if args.season is not None:
+                games = games[games['season'] == args.season]
         else:
-            neutralsite = None
-    # Create game, result
-    game = model.Game(date=espn.date, seasonid=espn.season.id,
-                      hometeamid=espn.hometeamlink.teamid,
-                      awayteamid=espn.awayteamlink.teamid,
-                      neutralsite=neutralsite, comments=comment)
-    result = model.GameResult(homepoints = espn.homepoints,
-                              awaypoints = espn.awaypoints,
-                              overtimes = espn.overtimes)
-    result.game = game
-    return game, result
-
-# Create a game from an unmatched NCAA game, prompting for info as necessary
-def game_from_ncaa(ncaa, overtimes=None, comment='Missing from ESPN.com'):
-    # Create full comment
-    if ncaa.comments is not None:
-        comment = ncaa.comments + ', ' + comment
-    # Prompt user for overtimes, if necessary
-    while overtimes is None:
-        overtimes = input('Overtimes: ')
-        try:
-            overtimes = int(overtimes)
-        except:
-            overtimes = None
-    # Create game, result
-    game = model.Game(date=ncaa.date, seasonid=ncaa.season.id,
-                      hometeamid=ncaa.hometeamlink.teamid,
-                      awayteamid=ncaa.awayteamlink.teamid,
-                      neutralsite=ncaa.neutralsite, comments=comment)
-    result = model.GameResult(homepoints = ncaa.homepoints,
-                              awaypoints = ncaa.awaypoints,
-                              overtimes = overtimes)
-    result.game = game
-    return game, result
-
-# Upload ESPN games if desired, prompting for each.
-print("\n")
-proceed = str(input("Upload unmatched ESPN games? (y/n) ")).lower()
-while proceed not in ['y','n']:
-    proceed = str(input("Upload unmatched ESPN games? (y/n) ")).lower()
-
-if proceed == 'y':
-    inserted = 0
-    duplicates = 0
-    for espn in espngames:
-        print_with_score(espn)
-        creategame = 'x'
-        while creategame not in ['y','n']:
-            creategame = str(input("Create this game? (y/n) ")).lower()
-        if creategame == 'y':
-            game, result = game_from_espn(espn)
-            if not game_is_duplicate(game, session):
-                inserted += 1
-                session.add(game)
-                session.add(result)
-            else:
-                duplicates += 1
-            # Delete the temporary rows we used to make this game
-            session.delete(espn)
-    session.commit()
-    print('Newly inserted:', inserted)
-    print('Duplicates not inserted:', duplicates)
-    
-# Upload NCAA games if desired, prompting for each.
-print("\n")
-proceed = str(input("Upload unmatched NCAA games? (y/n) ")).lower()
-while proceed not in ['y','n']:
-    proceed = str(input("Upload unmatched NCAA games? (y/n) ")).lower()
-
-if proceed == 'y':
-    inserted = 0
-    duplicates = 0
-    for ncaa in ncaagames:
-        print_with_score(ncaa)
-        creategame = 'x'
-        while creategame not in ['y','n']:
-            creategame = str(input("Create this game? (y/n) ")).lower()
-        if creategame == 'y':
-            game, result = game_from_ncaa(ncaa)
-            if not game_is_duplicate(game, session):
-                inserted += 1
-                session.add(game)
-                session.add(result)
-            else:
-                duplicates += 1
-            # Delete the temporary rows we used to make this game
-            session.delete(ncaa)
+            games = schedule.schedule(session, team, args.season)
+    except schedule.IndexNotBuilt as e:
+        print(e, file=sys.stderr)
+        return 1
+    for g in games.itertuples(index=False):
+        line = "{}: {}, {} {}".format(g.gameid, g.date.strftime("%Y-%m-%d"),
+                                      "vs" if g.home or g.neutralsite else "at", g.opponent)
+        if pandas.notna(g.points):
+            line += ": {} {}-{}".format('W' if g.points > g.opponentpoints else
+                                        'L' if g.points < g.opponentpoints else 'T',
+                                        int(g.points), int(g.opponentpoints))
+            if g.overtimes > 0:
+                line += " ({}OT)".format(int(g.overtimes))
+        if g.neutralsite:
+            line += " (neutral site)"
+        print(line)
+    print(len(games), "games.")
+    return 0
+
+def cmd_reindex(args, session):
+    """Rebuilds the team schedule index from the game table."""
+    import schedule
+    rows = schedule.rebuild(session)
     session.commit()
-    print('Newly inserted:', inserted)
-    print('Duplicates not inserted:', duplicates)
+    print("Indexed", rows, "team games.")
+    return 0
+
+def cmd_status(args, session):
+    """Prints the journal entries and staged games for a season or week."""
+    # NCAA pages belong to no week, so they're only shown for a whole season
+    entries = session.query(model.JournalEntry).filter(model.JournalEntry.seasonyear == args.season)
+    jobs = session.query(model.Job).filter(model.Job.seasonyear == args.season)
+    if args.week is not None:
+        entries = entries.filter(model.JournalEntry.week == str(args.week))
+        jobs = jobs.filter(model.Job.week == str(args.week))
+    entries = entries.order_by(model.JournalEntry.week, model.JournalEntry.completed)
+    for e in entries:
+        print("Week {:>4} {:<8} {:<10} {:<5} {:<10} {:>5} rows  {}".format(
+            e.week or '-', e.stage, e.source, e.division or '',
+            e.date.strftime("%Y-%m-%d") if e.date is not None else '',
+            e.rows if e.rows is not None else '',
+            e.completed.strftime("%Y-%m-%d %H:%M:%S")))
+    from sqlalchemy import func
+    for job in jobs.order_by(model.Job.id):
+        counts = session.query(model.StagedGame.datasource, func.count()
+                    ).filter(model.StagedGame.jobid == job.id
+                    ).group_by(model.StagedGame.datasource
+                    ).order_by(model.StagedGame.datasource)
+        print("Job {} (week {}, {}): {} games staged, {} matches".format(
+            job.id, job.week,
+            "no lease" if job.lease is None else "leased by {} at {}".format(
+                job.lease.owner, job.lease.renewed.strftime("%Y-%m-%d %H:%M:%S")),
+            ", ".join("{} from {}".format(n, datasource) for datasource, n in counts) or "no",
+            session.query(model.Match).filter(model.Match.jobid == job.id).count()))
+    return 0
+
+def cmd_export(args, session):
+    """Writes the games changed since a change sequence number as NDJSON
+    (to stdout or a file) or Parquet."""
+    import export
+    changes = export.iter_changes(session, args.since, args.batch)
+    if args.format == 'parquet':
+        if args.output is None:
+            print("--output is required for parquet.", file=sys.stderr)
+            return 1
+        count, seq = export.write_parquet(changes, args.output, args.batch)
+    elif args.output is None:
+        count, seq = export.write_ndjson(changes, sys.stdout)
+    else:
+        with open(args.output, 'w') as f:
+            count, seq = export.write_ndjson(changes, f)
+    # Tell the consumer where to continue from next time
+    print("Exported {} games. Last seq: {}".format(count, seq if seq is not None else args.since),
+          file=sys.stderr)
+    return 0
+
+def cmd_daemon(args, session):
+    """Runs the scheduler until interrupted, keeping the database up to date."""
+    import scheduler
+    budgets = dict(scheduler.DEFAULT_BUDGETS)
+    budgets.update(args.budgets or [])
+    statusfile = args.status_file
+    if statusfile is None:
+        statusfile = os.path.join(args.cachedir, "STATUS.json")
+    sched = scheduler.Scheduler(session, sourcenames=args.sources, cachedir=args.cachedir,
+                                backfill=args.backfill or [], budgets=budgets,
+                                statusfile=statusfile, workers=args.workers, checks=args.checks,
+                                live_interval=args.live_interval or scheduler.LIVE_INTERVAL)
+    if args.status_port is not None:
+        server = scheduler.serve_status(sched, port=args.status_port)
+        print("Serving status at http://{}:{}/".format(*server.server_address[:2]))
+    print("Writing status to", statusfile)
+    try:
+        sched.run()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+################################################################################
+
+def parse_week(value):
+    """Parses a week argument: 1-15, or B/Bowl for bowl games."""
+    if str(value) in map(str, range(1,16)):
+        return int(value)
+    elif str(value).lower() in ['b', 'bowl']:
+        return 'Bowl'
+    raise argparse.ArgumentTypeError("week must be 1-15 or B, not '{}'".format(value))
+
+def parse_date(value):
+    """Parses a date argument in YYYY-MM-DD format."""
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        raise argparse.ArgumentTypeError("dates must be YYYY-MM-DD, not '{}'".format(value))
+
+def parse_budget(value):
+    """Parses a request budget argument, HOST=REQUESTS/SECONDS."""
+    try:
+        host, budget = value.split('=')
+        requests, period = budget.split('/')
+        return host, (int(requests), float(period))
+    except ValueError:
+        raise argparse.ArgumentTypeError("budgets must be HOST=REQUESTS/SECONDS, not '{}'".format(value))
+
+def parse_check(value):
+    """Parses a data-quality check severity argument, CHECK=LEVEL."""
+    check, sep, level = value.partition('=')
+    if sep == '' or check == '' or level == '':
+        raise argparse.ArgumentTypeError("checks must be CHECK=LEVEL, not '{}'".format(value))
+    return check, level
+
+def make_parser():
+    parser = argparse.ArgumentParser(description="Fetch, match and upload college football games.")
+    parser.add_argument('--db', default=None,
+                        help="database URL (default: $CFB_DATABASE_URL or {})".format(db.DEFAULT_URL))
+    parser.add_argument('--cachedir', default=DEFAULT_CACHEDIR, help="directory for cached pages")
+    subparsers = parser.add_subparsers(dest='command')
+    # Commands working on one week
+    week_parent = argparse.ArgumentParser(add_help=False)
+    week_parent.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                             help="pages each source may fetch at once")
+    week_parent.add_argument('--source', dest='sources', action='append', default=None,
+                             help="datasource to fetch, in order; repeat for more "
+                                  "(default: {})".format(", ".join(sources.DEFAULT_SOURCES)))
+    week_parent.add_argument('--no-input', action='store_true',
+                             help="fail instead of prompting for unknown team ids")
+    week_parent.add_argument('--yes', '-y', action='store_true',
+                             help="answer yes to every upload question")
+    week_parent.add_argument('--check', dest='checks', type=parse_check, action='append', default=None,
+                             help="severity of a data-quality check, CHECK=error|warning|ignore; "
+                                  "repeat for more (default: validate.py and $CFB_VALIDATION)")
+    for name, func, helptext in [('fetch', cmd_fetch, "scrape (or read cached) games"),
+                                 ('match', cmd_match, "stage games and match the sources"),
+                                 ('upload', cmd_upload, "upload matched games")]:
+        sub = subparsers.add_parser(name, parents=[week_parent], help=helptext)
+        sub.add_argument('season', type=int)
+        sub.add_argument('week', type=parse_week)
+        sub.set_defaults(func=func)
+    sub = subparsers.add_parser('run', parents=[week_parent], help="match and upload a week")
+    sub.add_argument('season', type=int, nargs='?')
+    sub.add_argument('week', type=parse_week, nargs='?')
+    sub.set_defaults(func=cmd_run)
+    sub = subparsers.add_parser('daemon', help="keep the database up to date on a schedule")
+    sub.add_argument('--source', dest='sources', action='append', default=None,
+                     help="datasource to fetch, in order; repeat for more")
+    sub.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                     help="pages each source may fetch at once")
+    sub.add_argument('--backfill', type=int, action='append', default=None,
+                     help="an older season to fill in; repeat for more")
+    sub.add_argument('--check', dest='checks', type=parse_check, action='append', default=None,
+                     help="severity of a data-quality check, CHECK=error|warning|ignore; repeat for more")
+    sub.add_argument('--budget', dest='budgets', type=parse_budget, action='append', default=None,
+                     help="request budget for a host, HOST=REQUESTS/SECONDS; repeat for more")
+    sub.add_argument('--live-interval', type=float, default=None,
+                     help="seconds between fetches of a week with unfinished games")
+    sub.add_argument('--status-file', default=None,
+                     help="where to write the status json (default: CACHEDIR/STATUS.json)")
+    sub.add_argument('--status-port', type=int, default=None,
+                     help="also serve the status over HTTP on this port")
+    sub.set_defaults(func=cmd_daemon)
+    sub = subparsers.add_parser('reindex', help="rebuild the team schedule index")
+    sub.set_defaults(func=cmd_reindex)
+    # Read-only commands, which never create tables
+    sub = subparsers.add_parser('report', help="show games in the database")
+    sub.add_argument('start', type=parse_date)
+    sub.add_argument('end', type=parse_date, nargs='?')
+    sub.set_defaults(func=cmd_report, readonly=True)
+    sub = subparsers.add_parser('schedule', help="show a team's games, or its games against another")
+    sub.add_argument('team', help="team id or shortname")
+    sub.add_argument('season', type=int, nargs='?')
+    sub.add_argument('--opponent', default=None, help="only games against this team (id or shortname)")
+    sub.set_defaults(func=cmd_schedule, readonly=True)
+    sub = subparsers.add_parser('status', help="show progress for a season or week")
+    sub.add_argument('season', type=int)
+    sub.add_argument('week', type=parse_week, nargs='?')
+    sub.set_defaults(func=cmd_status, readonly=True)
+    sub = subparsers.add_parser('export', help="write games changed since a sequence number")
+    sub.add_argument('--since', type=int, default=0, help="last change seq already seen")
+    sub.add_argument('--format', choices=['ndjson', 'parquet'], default='ndjson')
+    sub.add_argument('--output', '-o', default=None, help="output file (default: stdout)")
+    sub.add_argument('--batch', type=int, default=10000, help="games to read at a time")
+    sub.set_defaults(func=cmd_export, readonly=True)
+    return parser
+
+def missing_tables(engine):
+    """Returns the names of the model's tables which aren't in the database."""
+    import sqlalchemy
+    existing = set(sqlalchemy.inspect(engine).get_table_names())
+    return [t.name for t in model.Base.metadata.sorted_tables if t.name not in existing]
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        # Old behavior: prompt for a week, then match and upload it
+        args = parser.parse_args(list(argv) + ['run'])
+    engine = db.get_engine(args.db)
+    if getattr(args, 'readonly', False):
+        # No DDL on read paths, so read-only database users can run these
+        missing = missing_tables(engine)
+        if len(missing) > 0:
+            print("The database has no {} table(s). Run a command which writes to it, "
+                  "such as reindex, to create them.".format(", ".join(missing)), file=sys.stderr)
+            return 1
+    else:
+        model.Base.metadata.create_all(engine)  # create any missing tables
+        if args.func is not cmd_reindex:
+            import schedule
+            schedule.ensure_index(engine)  # index games uploaded before teamgame existed
+    session = model.Session(bind=engine)
+    try:
+        return args.func(args, session)
+    finally:
+        session.close()
 
-session.close()
\ No newline at end of file
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,10 @@
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, ForeignKey, UniqueConstraint
-from sqlalchemy.types import Integer, String, Date, Boolean
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, ForeignKey, UniqueConstraint, Index, event
+from sqlalchemy.types import Integer, String, Date, Boolean, DateTime
+from sqlalchemy.orm import relationship, backref
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.sql import select, and_, or_
+from sqlalchemy.sql import select, and_, or_, case, text
+import datetime
 
 Base = declarative_base()
 Session = sessionmaker()
@@ -18,6 +19,9 @@ class Team(Base):
     
     homegames = relationship("Game", foreign_keys="Game.hometeamid", back_populates="hometeam")
     awaygames = relationship("Game", foreign_keys="Game.awayteamid", back_populates="awayteam")
+    # Home and away games together, in date order, through the teamgame index
+    teamgames = relationship("TeamGame", foreign_keys="TeamGame.teamid",
+                             order_by="TeamGame.date", viewonly=True)
     
     def __repr__(self):
         return "<Team(shortname='{}', longname='{}', mascot='{}')>".format(
@@ -136,39 +140,173 @@ class SourceTeamName(Base):
     
     team = relationship("Team")
 
+
+class Change(Base):
+    __tablename__ = 'change'
+    
+    seq = Column(Integer, primary_key=True)
+    tablename = Column(String, nullable=False)
+    gameid = Column(Integer, nullable=False, index=True)
+    operation = Column(String, nullable=False)
+    changed = Column(DateTime, nullable=False, default=datetime.datetime.now)
+    
+    def __repr__(self):
+        return "<Change(seq='{}', tablename='{}', gameid='{}', operation='{}', changed='{}')>".format(
+                self.seq, self.tablename, self.gameid, self.operation, self.changed)
+
+
+def _record_changes(session, flush_context):
+    """Adds a row to the change table for every Game or GameResult inserted,
+    updated or deleted by a flush, so that consumers can sync incrementally.
+
+    Sequence numbers are handed out here, before commit, so writers must
+    commit in sequence order or a consumer could read a higher seq before a
+    lower one is committed, and never see the lower one. SQLite only allows
+    one writing transaction at a time, which guarantees this. On Postgres the
+    change table is locked against other writers (readers aren't blocked)
+    until the transaction ends."""
+    changes = []
+    for operation, objs in [('insert', session.new), ('update', session.dirty),
+                            ('delete', session.deleted)]:
+        for obj in objs:
+            if isinstance(obj, (Game, GameResult)):
+                if operation == 'update' and not session.is_modified(obj):
+                    continue
+                changes.append({'tablename': obj.__tablename__, 'gameid': obj.id,
+                                'operation': operation, 'changed': datetime.datetime.now()})
+    if len(changes) > 0:
+        connection = session.connection()
+        if connection.dialect.name == 'postgresql':
+            connection.execute(text('LOCK TABLE change IN EXCLUSIVE MODE'))
+        connection.execute(Change.__table__.insert(), changes)
+
+event.listen(Session, 'after_flush', _record_changes)
+
+
+class TeamGame(Base):
+    __tablename__ = 'teamgame'
+    __table_args__ = (
+            # Cover schedule and head-to-head lookups, so they only read the
+            # index entries for one team
+            Index('ix_teamgame_schedule', 'teamid', 'seasonid', 'date', 'gameid', 'opponentid', 'home'),
+            Index('ix_teamgame_opponent', 'teamid', 'opponentid', 'date', 'gameid', 'home', 'seasonid'),
+            )
+    
+    teamid = Column(Integer, ForeignKey('team.id'), primary_key=True)
+    gameid = Column(Integer, ForeignKey('game.id'), primary_key=True, index=True)
+    seasonid = Column(Integer, ForeignKey('season.id'))
+    date = Column(Date, nullable=False)
+    opponentid = Column(Integer, ForeignKey('team.id'), nullable=False)
+    home = Column(Boolean, nullable=False)
+    
+    game = relationship("Game")
+    team = relationship("Team", foreign_keys=[teamid])
+    opponent = relationship("Team", foreign_keys=[opponentid])
+    
+    def __repr__(self):
+        return "<TeamGame(teamid='{}', gameid='{}', seasonid='{}', date='{}', opponentid='{}', home='{}')>".format(
+                self.teamid, self.gameid, self.seasonid, self.date, self.opponentid, self.home)
+
+
+def team_game_rows(game):
+    """Returns the two teamgame rows of a model.Game, as dictionaries."""
+    return [{'teamid': game.hometeamid, 'gameid': game.id, 'seasonid': game.seasonid,
+             'date': game.date, 'opponentid': game.awayteamid, 'home': True},
+            {'teamid': game.awayteamid, 'gameid': game.id, 'seasonid': game.seasonid,
+             'date': game.date, 'opponentid': game.hometeamid, 'home': False}]
+
+def _changed_games(session):
+    """Returns the Games a flush will insert, update and delete."""
+    return ([obj for obj in session.new if isinstance(obj, Game)],
+            [obj for obj in session.dirty if isinstance(obj, Game) and session.is_modified(obj)],
+            [obj for obj in session.deleted if isinstance(obj, Game)])
+
+def _unlink_team_games(session, flush_context, instances):
+    """Deletes the teamgame rows of Games about to be updated or deleted, before
+    the flush, so that no row ever refers to a deleted game."""
+    inserted, updated, deleted = _changed_games(session)
+    stale = [g.id for g in updated + deleted]
+    table = TeamGame.__table__
+    for i in range(0, len(stale), 500):
+        session.connection().execute(table.delete().where(table.c.gameid.in_(stale[i:i + 500])))
+
+def _link_team_games(session, flush_context):
+    """Adds the teamgame rows of Games inserted or updated by a flush, in the
+    same transaction."""
+    inserted, updated, deleted = _changed_games(session)
+    rows = [row for g in inserted + updated for row in team_game_rows(g)]
+    if len(rows) > 0:
+        session.connection().execute(TeamGame.__table__.insert(), rows)
+
+event.listen(Session, 'before_flush', _unlink_team_games)
+event.listen(Session, 'after_flush', _link_team_games)
+
+
+class JournalEntry(Base):
+    __tablename__ = 'journal'
+    
+    id = Column(Integer, primary_key=True)
+    stage = Column(String, nullable=False)
+    source = Column(String, nullable=False)
+    seasonyear = Column(Integer, nullable=False)
+    week = Column(String)
+    division = Column(String)
+    date = Column(Date)
+    rows = Column(Integer)
+    completed = Column(DateTime, nullable=False, default=datetime.datetime.now)
+    
+    def __repr__(self):
+        return "<JournalEntry(stage='{}', source='{}', seasonyear='{}', week='{}', division='{}', date='{}', rows='{}')>".format(
+                self.stage, self.source, self.seasonyear, self.week, self.division, self.date, self.rows)
+
 ################################################################################    
 
-class TempESPNGame(Base):
-    __tablename__ = 'espngame'
-    __table_args__ = {'prefixes':['TEMPORARY']}
+# Staging tables. Each run of the uploader is a Job, and its staged games and
+# matches are tagged with the job's id so that several jobs can share the
+# database (and survive a lost connection) without seeing each other's rows.
+
+class Job(Base):
+    __tablename__ = 'job'
     
     id = Column(Integer, primary_key=True)
-    away = Column(String, nullable=False)
-    awaypoints = Column(Integer, nullable=False)
-    home = Column(String, nullable=False)
-    homepoints = Column(Integer, nullable=False)
-    date = Column(Date, nullable=False)
-    comments = Column(String)
     seasonyear = Column(Integer, nullable=False)
-    overtimes = Column(Integer, nullable=False)
+    week = Column(String, nullable=False)
+    created = Column(DateTime, nullable=False, default=datetime.datetime.now)
     
-    # Relationships - joins have to be explicit
-    season = relationship("Season", primaryjoin="foreign(TempESPNGame.seasonyear)==remote(Season.start)")
-    hometeamlink = relationship("SourceTeamName",
-                                primaryjoin="and_(foreign(TempESPNGame.home) == remote(SourceTeamName.name), "
-                                            "remote(SourceTeamName.datasource)=='espn.com')"
-                                )
-    awayteamlink = relationship("SourceTeamName", 
-                                primaryjoin="and_(foreign(TempESPNGame.away) == remote(SourceTeamName.name), "
-                                            "remote(SourceTeamName.datasource)=='espn.com')"
-                                )
+    lease = relationship("JobLease", uselist=False, back_populates="job", cascade="all, delete-orphan")
+    
+    def __repr__(self):
+        return "<Job(id='{}', seasonyear='{}', week='{}', created='{}')>".format(
+                self.id, self.seasonyear, self.week, self.created)
+
+
+# Which worker is using a job, and when it last did anything with it. A job
+# whose lease hasn't been renewed for a while (or which has none) is stale and
+# may be dropped by other workers. A separate table, so that databases created
+# before leases existed only need the new table.
+class JobLease(Base):
+    __tablename__ = 'joblease'
+    
+    jobid = Column(Integer, ForeignKey('job.id'), primary_key=True)
+    owner = Column(String, nullable=False)
+    renewed = Column(DateTime, nullable=False, default=datetime.datetime.now)
+    
+    job = relationship("Job", back_populates="lease")
     
+    def __repr__(self):
+        return "<JobLease(jobid='{}', owner='{}', renewed='{}')>".format(
+                self.jobid, self.owner, self.renewed)
+
 
-class TempNCAAGame(Base):
-    __tablename__ = 'ncaagame'
-    __table_args__ = {'prefixes':['TEMPORARY']}
+class StagedGame(Base):
+    __tablename__ = 'stagedgame'
+    # Never reuse the ids of dropped jobs' games
+    __table_args__ = (Index('ix_stagedgame_jobid_datasource', 'jobid', 'datasource'),
+                      {'sqlite_autoincrement': True})
     
     id = Column(Integer, primary_key=True)
+    jobid = Column(Integer, ForeignKey('job.id'), nullable=False)
+    datasource = Column(String, nullable=False)
     away = Column(String, nullable=False)
     awaypoints = Column(Integer, nullable=False)
     home = Column(String, nullable=False)
@@ -176,75 +314,86 @@ class TempNCAAGame(Base):
     date = Column(Date, nullable=False)
     comments = Column(String)
     seasonyear = Column(Integer, nullable=False)
-    neutralsite = Column(Boolean, nullable=False)
+    # Not every source has these, so they may be None
+    overtimes = Column(Integer)
+    neutralsite = Column(Boolean)
     
     # Relationships - joins have to be explicit
-    season = relationship("Season", primaryjoin="foreign(TempNCAAGame.seasonyear)==remote(Season.start)")
+    season = relationship("Season", primaryjoin="foreign(StagedGame.seasonyear)==remote(Season.start)")
     hometeamlink = relationship("SourceTeamName",
-                                primaryjoin="and_(foreign(TempNCAAGame.home) == remote(SourceTeamName.name), "
-                                            "remote(SourceTeamName.datasource)=='ncaa.org')"
+                                primaryjoin="and_(foreign(StagedGame.home) == remote(SourceTeamName.name), "
+                                            "foreign(StagedGame.datasource) == remote(SourceTeamName.datasource))",
+                                viewonly=True
                                 )
     awayteamlink = relationship("SourceTeamName", 
-                                primaryjoin="and_(foreign(TempNCAAGame.away) == remote(SourceTeamName.name), "
-                                            "remote(SourceTeamName.datasource)=='ncaa.org')"
+                                primaryjoin="and_(foreign(StagedGame.away) == remote(SourceTeamName.name), "
+                                            "foreign(StagedGame.datasource) == remote(SourceTeamName.datasource))",
+                                viewonly=True
                                 )
+    
+    def __repr__(self):
+        return "<StagedGame(id='{}', datasource='{}', date='{}', home='{}', away='{}')>".format(
+                self.id, self.datasource, self.date, self.home, self.away)
 
 
-# Create the query for linking temporary NCAA and ESPN games
-_ncaagame = TempNCAAGame.__table__
-_espngame = TempESPNGame.__table__
-_homename = SourceTeamName.__table__.alias()
-_awayname = SourceTeamName.__table__.alias()
-_ncaa_ids = select(
-                    [_ncaagame, 
-                    _awayname.c.teamid.label('awayteamid'), 
-                    _homename.c.teamid.label('hometeamid')]
-                  ).select_from(
-                    _ncaagame.outerjoin(_homename, 
-                        and_(_ncaagame.c.home==_homename.c.name, _homename.c.datasource=='ncaa.org')
-                    ).outerjoin(_awayname,
-                        and_(_ncaagame.c.away==_awayname.c.name, _awayname.c.datasource=='ncaa.org')
-                    )
-                  ).alias()
-_espn_ids = select(
-                    [_espngame, 
-                    _awayname.c.teamid.label('awayteamid'), 
-                    _homename.c.teamid.label('hometeamid')]
-                  ).select_from(
-                    _espngame.outerjoin(_homename, 
-                        and_(_espngame.c.home==_homename.c.name, _homename.c.datasource=='espn.com')
-                    ).outerjoin(_awayname,
-                        and_(_espngame.c.away==_awayname.c.name, _awayname.c.datasource=='espn.com')
+# Create the query for matching staged games
+_stagedgame = StagedGame.__table__
+
+def _with_teamids(gametable, jobid):
+    """Returns a subquery of the job's rows in gametable, with the team ids of
+    the home and away teams looked up from sourceteamname for each row's
+    datasource."""
+    homename = SourceTeamName.__table__.alias()
+    awayname = SourceTeamName.__table__.alias()
+    return select(
+                    [gametable, 
+                    awayname.c.teamid.label('awayteamid'), 
+                    homename.c.teamid.label('hometeamid')]
+                 ).select_from(
+                    gametable.outerjoin(homename, 
+                        and_(gametable.c.home==homename.c.name,
+                             gametable.c.datasource==homename.c.datasource)
+                    ).outerjoin(awayname,
+                        and_(gametable.c.away==awayname.c.name,
+                             gametable.c.datasource==awayname.c.datasource)
                     )
-                  ).alias()
-match_query = select(
-                        [_espn_ids.c.id.label('espngameid'), _ncaa_ids.c.id.label('ncaagameid')]
-                     ).select_from(
-                        _espn_ids.join(_ncaa_ids, 
-                            or_(
-                                and_(
-                                    _espn_ids.c.hometeamid == _ncaa_ids.c.hometeamid,
-                                    _espn_ids.c.awayteamid == _ncaa_ids.c.awayteamid,
-                                    _espn_ids.c.date == _ncaa_ids.c.date
-                                ),
-                                and_(
-                                    _espn_ids.c.hometeamid == _ncaa_ids.c.awayteamid,
-                                    _espn_ids.c.awayteamid == _ncaa_ids.c.hometeamid,
-                                    _espn_ids.c.date == _ncaa_ids.c.date,
-                                    _ncaa_ids.c.neutralsite == True
-                                )
-                            )
-                        )
-                     )
+                 ).where(
+                    gametable.c.jobid == jobid
+                 ).alias()
+
+def match_query(jobid):
+    """Returns a query of the match key of every staged game of the given job
+    whose teams are known: its date and the lower and higher of its two team
+    ids, so that games listed with either team at home get the same key.
+    Staged games with the same key, from any number of sources, are the same
+    game. This is one pass over the staged rows, rather than a join between
+    each pair of sources."""
+    games = _with_teamids(_stagedgame, jobid)
+    return select(
+                    [games.c.id.label('stagedgameid'),
+                    games.c.jobid,
+                    games.c.date,
+                    games.c.hometeamid,
+                    games.c.awayteamid,
+                    case([(games.c.hometeamid < games.c.awayteamid, games.c.hometeamid)],
+                         else_=games.c.awayteamid).label('team1id'),
+                    case([(games.c.hometeamid < games.c.awayteamid, games.c.awayteamid)],
+                         else_=games.c.hometeamid).label('team2id')]
+                 ).where(
+                    and_(games.c.hometeamid != None, games.c.awayteamid != None)
+                 )
 
-# Now make the view
+# The match key of each staged game, filled from match_query
 class Match(Base):
     __tablename__ = 'matches'
-    __table_args__ = {'prefixes':['TEMPORARY']}
+    __table_args__ = (Index('ix_matches_key', 'jobid', 'date', 'team1id', 'team2id'),)
     
-    espngameid = Column(Integer, ForeignKey('espngame.id'), primary_key=True)
-    ncaagameid = Column(Integer, ForeignKey('ncaagame.id'), primary_key=True)
+    stagedgameid = Column(Integer, ForeignKey('stagedgame.id'), primary_key=True)
+    jobid = Column(Integer, ForeignKey('job.id'), nullable=False)
+    date = Column(Date, nullable=False)
+    hometeamid = Column(Integer, ForeignKey('team.id'), nullable=False)
+    awayteamid = Column(Integer, ForeignKey('team.id'), nullable=False)
+    team1id = Column(Integer, ForeignKey('team.id'), nullable=False)
+    team2id = Column(Integer, ForeignKey('team.id'), nullable=False)
     
-    espngame = relationship("TempESPNGame", backref='matches')
-    ncaagame = relationship("TempNCAAGame", backref='matches')
-                             
\ No newline at end of file
+    stagedgame = relationship("StagedGame", backref=backref('match', uselist=False))
@@ -1,25 +1,42 @@
 import requests
 import datetime
+import os
 import bs4
 import pandas
 import dateutil.parser as dateparser
 
+import frames
+import journal
+import ratelimit
+import sources
+
+# Where to find stats.ncaa.org. Override to point at a local fixture server.
+BASE_URL = os.environ.get('CFB_NCAA_URL', 'http://stats.ncaa.org')
+SCOREBOARD_PATH = '/contests/scoreboards'
+DIVISION_CODES = {'FBS':11,'FCS':12,'D2':2,'D3':3}
+
+DIVISIONS = ['FBS', 'FCS', 'D2', 'D3']
+
 
 def _get_date_page(season, division, date):
     """Returns the page for all teams in the given division/year as a requests
-    Response object.
+    Response object. Raises requests.HTTPError if the page couldn't be
+    fetched (e.g. when rate limited), so it's retried rather than read as a
+    day without games.
     
     season - an integer
     division - one of 'FBS', 'FCS', 'D2', or 'D3'
     date - a date"""
-    url = 'http://stats.ncaa.org/contests/scoreboards'
-    division_codes = {'FBS':11,'FCS':12,'D2':2,'D3':3}
+    url = BASE_URL + SCOREBOARD_PATH
     params = {'sport_code': 'MFB',
               'conf_id': -1,
               'academic_year': int(season) + 1,
-              'division': division_codes[division],
+              'division': DIVISION_CODES[division],
               'game_date':datetime.date.strftime(date, "%m/%d/%Y")}
-    return requests.get(url, params=params)
+    ratelimit.wait(url)
+    response = requests.get(url, params=params)
+    response.raise_for_status()
+    return response
 
 def _get_division_date_games(season, division, date):
     """Returns a pandas DataFrame of all games taking place in that season,
@@ -86,23 +103,109 @@ def _parse_game(tablerows):
     return gamedata
     
     
-def get_date_games(season, date, retries=3):
-    """Returns a pandas DataFrame of all games taking place in that season, on that date
+def iter_division_date_games(season, units, retries=3):
+    """Yields (division, date, games) for each (division, date) in units,
+    fetching each page exactly once. games is a compacted pandas DataFrame of
+    every game on the page (see frames.compact_games), including any not on
+    that date, or None if every attempt to fetch the page failed.
     
     season - an integer
-    date - a date."""
-    divlist = []
-    for div in ['FBS', 'FCS', 'D2', 'D3']:
+    units - a list of (division, date) tuples
+    retries - number of attempts for each page"""
+    for div, date in units:
+        games = None
         for i in range(retries):
             try:
-                divlist.append(_get_division_date_games(season, div, date))
+                games = frames.compact_games(_get_division_date_games(season, div, date))
                 break
             except:
                 continue
-    allgames = pandas.concat(divlist)
+        yield div, date, games
+
+def get_range_games(season, start, end, dates=None, retries=3, divisions=DIVISIONS):
+    """Returns a pandas DataFrame of all games taking place in that season
+    between start and end (inclusive), or None if there are none. Each
+    (division, date) page is fetched once, and every game on it is kept.
+    
+    season - an integer
+    start, end - dates
+    dates - the dates in the range with games, if known (e.g. from ESPN's
+        schedule). Otherwise every day in the range is fetched.
+    divisions - a list of divisions, some of 'FBS', 'FCS', 'D2', 'D3'"""
+    if dates is None:
+        dates = [start + datetime.timedelta(days=n) for n in range((end - start).days + 1)]
+    dates = sorted({d for d in dates if start <= d <= end})
+    units = [(div, d) for d in dates for div in divisions]
+    allgames = frames.concat_games(games for div, d, games
+                                   in iter_division_date_games(season, units, retries))
     if len(allgames) > 0:
-        allgames = allgames[allgames['Date'] == date]
+        allgames = allgames[(allgames['Date'] >= pandas.Timestamp(start))
+                            & (allgames['Date'] <= pandas.Timestamp(end))]
         return allgames.drop_duplicates().reset_index(drop=True)
     else:
         return None
 
+def get_date_games(season, date, retries=3, divisions=DIVISIONS):
+    """Returns a pandas DataFrame of all games taking place in that season, on that date
+    
+    season - an integer
+    date - a date.
+    divisions - a list of divisions, some of 'FBS', 'FCS', 'D2', 'D3'"""
+    return get_range_games(season, date, date, [date], retries, divisions)
+
+
+class NCAASource(sources.Source):
+    """stats.ncaa.org's scoreboard pages, fetched by date. Has neutral sites
+    but no overtimes."""
+
+    name = 'ncaa.org'
+    label = 'NCAA'
+    sitename = sources.get_sitename(name)
+
+    def fetch(self, season, week, session, cachedir, dates=None, echo=True, workers=1):
+        """Returns the games on the given dates (those found by the sources
+        fetched before this one). NCAA pages don't depend on the week, so
+        they're journaled by (division, date) alone and never fetched twice
+        for overlapping weeks. Pages for today or later, or for recent dates
+        (see sources.pending_cutoff) with games that have no score yet, are
+        fetched again next time. See sources.Source.fetch."""
+        dates = sorted(dates or [])
+        units = {}
+        for d in dates:
+            for div in DIVISIONS:
+                filename = "NCAA-{}-{}-{}.csv".format(season, div, d.strftime("%Y%m%d"))
+                units[(div, d)] = sources.read_cached_unit(session, cachedir, filename,
+                                                           self.name, season, None, division=div, date=d)
+        missing = [unit for unit in units if units[unit] is None]
+        if echo:
+            print("Fetching NCAA games ({} of {} pages cached)...".format(
+                    len(units) - len(missing), len(units)),
+                  end=" ", flush=True)
+        for div, d, games in iter_division_date_games(season, missing):
+            if games is not None:
+                filename = "NCAA-{}-{}-{}.csv".format(season, div, d.strftime("%Y%m%d"))
+                pending = d >= datetime.date.today() or (
+                    d >= sources.pending_cutoff() and len(games) > 0
+                    and games[['HomePoints', 'AwayPoints']].isna().any(axis=None))
+                sources.cache_unit(games, session, cachedir, filename,
+                                   self.name, season, None, division=div, date=d,
+                                   complete=not pending)
+            units[(div, d)] = games
+        games = frames.concat_games(units.values())
+        # Pages can include games on other dates. They stay in the cache, but
+        # only this week's games are returned.
+        if len(games) > 0:
+            games = games[(games['Date'] >= pandas.Timestamp(dates[0]))
+                          & (games['Date'] <= pandas.Timestamp(dates[-1]))]
+            games = games.drop_duplicates().reset_index(drop=True)
+        if echo:
+            print(len(games), "games.")
+        return games
+
+    def fetched(self, session, season, week, dates=None):
+        """Returns True if every division's page has been fetched for each of
+        the dates, with every recent game finished. See sources.Source.fetched."""
+        return all(journal.is_done(session, 'fetched', self.name, season, None, division=div, date=d)
+                   for d in (dates or []) for div in DIVISIONS)
+
+SOURCE = NCAASource()
@@ -0,0 +1,216 @@
+"""Read access to uploaded games, as DataFrames (or Arrow tables).
+
+games() runs a single pre-joined query (game, result, teams, season and each
+team's division and conference that season) rather than loading model.Game
+objects and their relationships one at a time. Results are paged by game id
+(keyset pagination), and pages are kept in an LRU cache which is invalidated
+whenever a game changes (see export.last_seq), or by calling invalidate().
+"""
+
+import collections
+
+import pandas
+from sqlalchemy.sql import select, and_, or_
+
+import model
+
+CACHE_SIZE = 256
+
+_cache = collections.OrderedDict()
+
+_game = model.Game.__table__
+_result = model.GameResult.__table__
+_season = model.Season.__table__
+_team = model.Team.__table__
+_teamgame = model.TeamGame.__table__
+_hometeam = model.Team.__table__.alias('hometeam')
+_awayteam = model.Team.__table__.alias('awayteam')
+_homediv = model.TeamDivision.__table__.alias('homediv')
+_awaydiv = model.TeamDivision.__table__.alias('awaydiv')
+_homedivname = model.Division.__table__.alias('homedivname')
+_awaydivname = model.Division.__table__.alias('awaydivname')
+_homeconf = model.TeamConference.__table__.alias('homeconf')
+_awayconf = model.TeamConference.__table__.alias('awayconf')
+_homeconfname = model.Conference.__table__.alias('homeconfname')
+_awayconfname = model.Conference.__table__.alias('awayconfname')
+
+_joined = _game.join(
+        _hometeam, _game.c.hometeamid == _hometeam.c.id
+    ).join(
+        _awayteam, _game.c.awayteamid == _awayteam.c.id
+    ).outerjoin(
+        _result, _game.c.id == _result.c.id
+    ).outerjoin(
+        _season, _game.c.seasonid == _season.c.id
+    ).outerjoin(
+        _homediv, and_(_homediv.c.teamid == _game.c.hometeamid,
+                       _homediv.c.seasonid == _game.c.seasonid)
+    ).outerjoin(
+        _homedivname, _homediv.c.divisionid == _homedivname.c.id
+    ).outerjoin(
+        _awaydiv, and_(_awaydiv.c.teamid == _game.c.awayteamid,
+                       _awaydiv.c.seasonid == _game.c.seasonid)
+    ).outerjoin(
+        _awaydivname, _awaydiv.c.divisionid == _awaydivname.c.id
+    ).outerjoin(
+        _homeconf, and_(_homeconf.c.teamid == _game.c.hometeamid,
+                        _homeconf.c.seasonid == _game.c.seasonid)
+    ).outerjoin(
+        _homeconfname, _homeconf.c.conferenceid == _homeconfname.c.id
+    ).outerjoin(
+        _awayconf, and_(_awayconf.c.teamid == _game.c.awayteamid,
+                        _awayconf.c.seasonid == _game.c.seasonid)
+    ).outerjoin(
+        _awayconfname, _awayconf.c.conferenceid == _awayconfname.c.id
+    )
+
+_columns = [
+    _game.c.id.label('gameid'),
+    _game.c.date.label('date'),
+    _season.c.start.label('season'),
+    _game.c.hometeamid.label('hometeamid'),
+    _hometeam.c.shortname.label('home'),
+    _game.c.awayteamid.label('awayteamid'),
+    _awayteam.c.shortname.label('away'),
+    _result.c.homepoints.label('homepoints'),
+    _result.c.awaypoints.label('awaypoints'),
+    _result.c.overtimes.label('overtimes'),
+    _game.c.neutralsite.label('neutralsite'),
+    _homedivname.c.shortname.label('homedivision'),
+    _awaydivname.c.shortname.label('awaydivision'),
+    _homeconfname.c.shortname.label('homeconference'),
+    _awayconfname.c.shortname.label('awayconference'),
+    _game.c.comments.label('comments'),
+    _result.c.comments.label('resultcomments'),
+    ]
+
+_category_columns = ['home', 'away', 'homedivision', 'awaydivision',
+                     'homeconference', 'awayconference']
+
+def _team_filter(team, use_index=True):
+    """Returns a filter for games involving team, given as an id or shortname,
+    using the teamgame index rather than OR-ing the home and away teams
+    (unless use_index is False, e.g. while the index hasn't been filled)."""
+    if isinstance(team, int):
+        teamid = team
+    else:
+        teamid = select([_team.c.id]).where(_team.c.shortname == team).as_scalar()
+    if not use_index:
+        return or_(_game.c.hometeamid == teamid, _game.c.awayteamid == teamid)
+    return _game.c.id.in_(select([_teamgame.c.gameid]).where(_teamgame.c.teamid == teamid))
+
+def games_query(season=None, team=None, date_range=None, division=None,
+                conference=None, after=None, limit=None, use_index=True):
+    """Returns the sqlalchemy select used by games(). See games() for the
+    meaning of the arguments; use_index is whether to find a team's games
+    with the teamgame index."""
+    conditions = []
+    if season is not None:
+        conditions.append(_season.c.start == season)
+    if team is not None:
+        conditions.append(_team_filter(team, use_index))
+    if date_range is not None:
+        start, end = date_range
+        if start is not None:
+            conditions.append(_game.c.date >= start)
+        if end is not None:
+            conditions.append(_game.c.date <= end)
+    if division is not None:
+        conditions.append(or_(_homedivname.c.shortname == division,
+                              _awaydivname.c.shortname == division))
+    if conference is not None:
+        conditions.append(or_(_homeconfname.c.shortname == conference,
+                              _awayconfname.c.shortname == conference))
+    if after is not None:
+        conditions.append(_game.c.id > after)
+    query = select(_columns).select_from(_joined)
+    if len(conditions) > 0:
+        query = query.where(and_(*conditions))
+    query = query.order_by(_game.c.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+def _url(bind):
+    """Returns the database url of a session, connection or engine."""
+    engine = getattr(bind, 'bind', None) or getattr(bind, 'engine', None) or bind
+    return str(engine.url)
+
+def _data_version(bind):
+    """Returns a value which changes whenever games are uploaded."""
+    import export
+    return export.last_seq(bind)
+
+def invalidate():
+    """Empties the result cache."""
+    _cache.clear()
+
+def games(bind, season=None, team=None, date_range=None, division=None,
+          conference=None, after=None, limit=None, astype='pandas', cache=True):
+    """Returns a page of games as a pandas DataFrame (or pyarrow Table), one
+    row per game, ordered by gameid.
+
+    bind - a session, connection or engine
+    season - the starting year of a season
+    team - a team id or shortname; games where it is home or away
+    date_range - a (start, end) tuple of dates, inclusive. Either may be None.
+    division - a division shortname; games where either team was in it
+    conference - a conference shortname; games where either team was in it
+    after - only games with a gameid greater than this. Pass the last gameid
+        of the previous page to get the next page.
+    limit - the maximum number of games to return
+    astype - 'pandas' or 'arrow'
+    cache - whether to use the result cache"""
+    if astype not in ['pandas', 'arrow']:
+        raise ValueError("astype must be 'pandas' or 'arrow'")
+    key = (_url(bind), season, team,
+           None if date_range is None else tuple(date_range),
+           division, conference, after, limit)
+    result = None
+    if cache:
+        version = _data_version(bind)
+        if key in _cache and _cache[key][0] == version:
+            _cache.move_to_end(key)
+            result = _cache[key][1]
+    if result is None:
+        # Until the teamgame index is filled (see schedule.ensure_index),
+        # fall back to scanning game for the team
+        use_index = True
+        if team is not None:
+            import schedule
+            use_index = schedule.index_ready(bind)
+        query = games_query(season, team, date_range, division, conference, after, limit,
+                            use_index)
+        rows = bind.execute(query).fetchall()
+        result = pandas.DataFrame([tuple(r) for r in rows],
+                                  columns=[c.key for c in _columns])
+        for col in _category_columns:
+            result[col] = result[col].astype('category')
+        if cache:
+            _cache[key] = (version, result)
+            while len(_cache) > CACHE_SIZE:
+                _cache.popitem(last=False)
+    if astype == 'arrow':
+        return _to_arrow(result)
+    # Copy so callers can't modify the cached frame
+    return result.copy()
+
+def iter_games(bind, pagesize=1000, **kwargs):
+    """Yields pages of games (see games) of at most pagesize rows each, until
+    all matching games have been returned. Other arguments are passed on to
+    games()."""
+    after = kwargs.pop('after', None)
+    astype = kwargs.pop('astype', 'pandas')
+    while True:
+        page = games(bind, after=after, limit=pagesize, **kwargs)
+        if len(page) == 0:
+            return
+        yield page if astype == 'pandas' else _to_arrow(page)
+        if len(page) < pagesize:
+            return
+        after = int(page['gameid'].iloc[-1])
+
+def _to_arrow(frame):
+    """Converts a DataFrame to a pyarrow Table."""
+    import pyarrow
+    return pyarrow.Table.from_pandas(frame, preserve_index=False)
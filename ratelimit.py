@@ -0,0 +1,73 @@
+"""Per-host request budgets, shared by every scraper in the process.
+
+A budget allows a number of requests to a host per period, refilling
+continuously (a token bucket), so a burst up to the full budget is allowed
+after a quiet spell. The scrapers call wait(url) before each request, which
+blocks until the host's budget allows it. Hosts without a budget are never
+held up.
+"""
+
+import threading
+import time
+import urllib.parse
+
+class Budget:
+    """A token bucket allowing requests per period seconds."""
+
+    def __init__(self, requests, period):
+        self.requests = requests
+        self.period = period
+        self.tokens = float(requests)
+        self.updated = time.monotonic()
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.requests,
+                          self.tokens + (now - self.updated) * self.requests / self.period)
+        self.updated = now
+
+    def available(self):
+        """Returns the number of requests which could be made right now."""
+        with self.lock:
+            self._refill()
+            return int(self.tokens)
+
+    def try_acquire(self):
+        """Takes one request from the budget and returns 0, or returns the
+        number of seconds until one is available."""
+        with self.lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.used += 1
+                return 0
+            return (1 - self.tokens) * self.period / self.requests
+
+    def acquire(self):
+        """Takes one request from the budget, waiting until one is available."""
+        delay = self.try_acquire()
+        while delay > 0:
+            time.sleep(delay)
+            delay = self.try_acquire()
+
+    def __repr__(self):
+        return "<Budget(requests='{}', period='{}')>".format(self.requests, self.period)
+
+
+BUDGETS = {}
+
+def host(url):
+    """Returns the host name of a URL."""
+    return urllib.parse.urlsplit(url).hostname
+
+def set_budget(hostname, requests, period):
+    """Allows requests requests to hostname every period seconds."""
+    BUDGETS[hostname] = Budget(requests, period)
+
+def wait(url):
+    """Blocks until a request to url's host is allowed by its budget."""
+    budget = BUDGETS.get(host(url))
+    if budget is not None:
+        budget.acquire()
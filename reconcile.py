@@ -0,0 +1,392 @@
+"""Rule-based reconciliation of a job's staged games, from any number of
+sources, into model.Game and model.GameResult rows, without prompting for
+each game.
+
+Staged games are grouped into games by their match key (see
+model.match_query): the date and the pair of teams, whichever is at home.
+Grouping is a single pass over the staged rows, however many sources there
+are. Each field of a game is then taken from its sources by the rules (see
+DEFAULT_RULES), and scores by majority or precedence. Games which the rules
+can't settle, such as score disagreements or a game with no neutral site
+information, are written to a review file. Once someone fills in the review
+file, apply_review uploads all of it in one transaction. Review rows name
+their staged games by match key rather than by id, so they still apply after
+the week has been staged again by a later job.
+"""
+
+import collections
+import csv
+import datetime
+
+import sqlalchemy
+
+import model
+
+# For each field, the sources to take it from, in order of precedence. Sources
+# not listed come after the listed ones, in alphabetical order. Only ESPN has
+# overtimes and only NCAA has neutral sites. 'scores' may also be 'majority',
+# meaning that more than half of a game's sources must agree on the score, or
+# 'agree', meaning that all of them must; otherwise the game goes to review.
+# The defaults are used when no source has the field; None sends the game to
+# review instead.
+DEFAULT_RULES = {
+    'date': ['espn.com', 'ncaa.org'],
+    'teams': ['espn.com', 'ncaa.org'],
+    'scores': 'majority',
+    'overtimes': ['espn.com'],
+    'neutralsite': ['ncaa.org'],
+    'default_overtimes': None,
+    'default_neutralsite': None,
+    # Games between the same teams up to this many days apart are the same
+    # game if no source lists both (e.g. late games dated differently)
+    'pair_days': 1,
+}
+
+REVIEW_FIELDS = ['kind', 'reason', 'matchkeys', 'date', 'seasonid',
+                 'hometeamid', 'home', 'awayteamid', 'away', 'sourcescores',
+                 'comments', 'homepoints', 'awaypoints', 'overtimes', 'neutralsite',
+                 'action']
+
+# How many ids to put in one IN clause
+_CHUNK = 500
+
+def game_is_duplicate(testgame, session):
+    """Returns True if a model.Game already exists in the database (or is
+    pending in the session) for the same date and teams."""
+    potentialmatches = session.query(model.Game).filter(
+        sqlalchemy.or_(
+            sqlalchemy.and_(
+                model.Game.hometeamid == testgame.hometeamid,
+                model.Game.awayteamid == testgame.awayteamid,
+                model.Game.date == testgame.date),
+            sqlalchemy.and_(
+                model.Game.hometeamid == testgame.awayteamid,
+                model.Game.awayteamid == testgame.hometeamid,
+                model.Game.date == testgame.date,
+                testgame.neutralsite == True),
+        )
+    )
+    n = potentialmatches.count()
+    if n == 0:
+        return False
+    elif n == 1:
+        return True
+    else:
+        raise Exception('Duplicate games in database.')
+
+def _ordered(precedence, listings):
+    """Returns the datasources of a game's listings (a dict of datasource:
+    model.Match) in order of precedence."""
+    listed = [s for s in precedence if s in listings]
+    return listed + sorted(s for s in listings if s not in listed)
+
+def _first(listings, precedence, attr):
+    """Returns the first non-None value of attr among the staged games of the
+    listings, in order of precedence."""
+    for name in _ordered(precedence, listings):
+        value = getattr(listings[name].stagedgame, attr)
+        if value is not None:
+            return value
+    return None
+
+def oriented_points(match, hometeamid):
+    """Returns (homepoints, awaypoints) of a staged game (given by its
+    model.Match), flipped if needed so that 'home' is hometeamid."""
+    game = match.stagedgame
+    if match.hometeamid == hometeamid:
+        return game.homepoints, game.awaypoints
+    return game.awaypoints, game.homepoints
+
+def _scores(listings, rule, hometeamid):
+    """Returns the (homepoints, awaypoints) chosen by the scores rule, or None
+    if the sources don't settle it."""
+    if rule in ['majority', 'agree']:
+        counts = collections.Counter(oriented_points(m, hometeamid) for m in listings.values())
+        points, n = counts.most_common(1)[0]
+        needed = len(listings) if rule == 'agree' else len(listings) // 2 + 1
+        return points if n >= needed else None
+    return oriented_points(listings[_ordered(rule, listings)[0]], hometeamid)
+
+def _combine_comments(*comments):
+    """Joins all comments that aren't None, or returns None."""
+    comments = [c for c in comments if c is not None]
+    return ', '.join(comments) if len(comments) > 0 else None
+
+def match_key(match):
+    """Returns the match key of a model.Match as written in review files,
+    DATE/TEAM1ID/TEAM2ID."""
+    return '{}/{}/{}'.format(match.date.isoformat(), match.team1id, match.team2id)
+
+def _parse_match_key(key):
+    """Returns (date, team1id, team2id) from a review file match key."""
+    date, team1id, team2id = key.split('/')
+    return datetime.datetime.strptime(date, "%Y-%m-%d").date(), int(team1id), int(team2id)
+
+def _review_row(kind, reason, listings, rules, fields, matches=None):
+    """Returns a review file row for staged games that couldn't be resolved.
+    fields holds whatever values were resolved, used to prefill the row.
+    matches are all of the game's model.Match rows, if listings leaves some
+    out."""
+    names = _ordered(rules['teams'], listings)
+    base = listings[names[0]]
+    if matches is None:
+        matches = listings.values()
+    row = {f: None for f in REVIEW_FIELDS}
+    row.update({
+        'kind': kind,
+        'reason': reason,
+        'matchkeys': ' '.join(sorted({match_key(m) for m in matches})),
+        'date': base.stagedgame.date,
+        'seasonid': base.stagedgame.season.id,
+        'hometeamid': base.hometeamid,
+        'home': base.stagedgame.hometeamlink.team.shortname,
+        'awayteamid': base.awayteamid,
+        'away': base.stagedgame.awayteamlink.team.shortname,
+        'sourcescores': '; '.join('{} {}-{}'.format(s, *oriented_points(listings[s], base.hometeamid))
+                                  for s in names),
+        })
+    for f in ['comments', 'homepoints', 'awaypoints', 'overtimes', 'neutralsite']:
+        if fields.get(f) is not None:
+            row[f] = fields[f]
+    return row
+
+def resolve(kind, listings, rules=DEFAULT_RULES, comment=None, seasonid=None):
+    """Resolves one game from its staged rows by the rules. Returns a tuple
+    (game, result, None) if it was resolved, or (None, None, reviewrow) if not.
+
+    kind - 'match', or the datasource of a game from a single source,
+        recorded in the review file
+    listings - a dictionary of datasource: model.Match, one per source
+    rules - see DEFAULT_RULES
+    comment - an extra comment for the game, e.g. which sources were missing
+    seasonid - the id of the game's model.Season, if already known"""
+    base = listings[_ordered(rules['teams'], listings)[0]]
+    hometeamid = base.hometeamid
+    fields = {
+        'date': _first(listings, rules['date'], 'date'),
+        'comments': _combine_comments(*([listings[s].stagedgame.comments
+                                         for s in _ordered(rules['teams'], listings)] + [comment])),
+        'overtimes': _first(listings, rules['overtimes'], 'overtimes'),
+        'neutralsite': _first(listings, rules['neutralsite'], 'neutralsite'),
+        }
+    if fields['overtimes'] is None:
+        fields['overtimes'] = rules['default_overtimes']
+    if fields['neutralsite'] is None:
+        fields['neutralsite'] = rules['default_neutralsite']
+    reason = None
+    # Sources may only list the teams the other way around at neutral sites
+    if any(m.hometeamid != hometeamid and m.stagedgame.neutralsite == False
+           for m in listings.values()):
+        reason = 'Home and away disagreement'
+    # Scores
+    points = _scores(listings, rules['scores'], hometeamid)
+    if reason is None and points is None:
+        reason = 'Score disagreement'
+    elif points is not None:
+        fields['homepoints'], fields['awaypoints'] = points
+    if reason is None and fields['overtimes'] is None:
+        reason = 'Overtimes unknown'
+    if reason is None and fields['neutralsite'] is None:
+        reason = 'Neutral site unknown'
+    if reason is not None:
+        return None, None, _review_row(kind, reason, listings, rules, fields)
+    # Create game, result
+    if seasonid is None:
+        seasonid = base.stagedgame.season.id
+    game = model.Game(date=fields['date'], seasonid=seasonid,
+                      hometeamid=hometeamid,
+                      awayteamid=base.awayteamid,
+                      neutralsite=fields['neutralsite'], comments=fields['comments'])
+    result = model.GameResult(homepoints=fields['homepoints'],
+                              awaypoints=fields['awaypoints'],
+                              overtimes=fields['overtimes'])
+    result.game = game
+    return game, result, None
+
+def find_games(session, job, rules=DEFAULT_RULES):
+    """Returns the staged games of a job grouped into games, as a list of
+    lists of model.Match (each with its staged game loaded), using one query
+    and one pass over the rows.
+
+    Games with the same match key are the same game. Then games between the
+    same teams up to rules['pair_days'] apart are merged, as long as no
+    source lists both."""
+    rows = session.query(model.Match, model.StagedGame).join(
+                model.StagedGame, model.Match.stagedgameid == model.StagedGame.id
+           ).filter(model.Match.jobid == job.id)
+    bykey = collections.OrderedDict()
+    for m, g in rows:
+        bykey.setdefault((m.team1id, m.team2id, m.date), []).append(m)
+    # Merge games between the same teams on nearby dates
+    byteams = collections.OrderedDict()
+    for (team1id, team2id, date), game in sorted(bykey.items(), key=lambda item: item[0]):
+        earlier = byteams.setdefault((team1id, team2id), [])
+        if len(earlier) > 0:
+            prev = earlier[-1]
+            if ((date - prev[-1].date).days <= rules['pair_days']
+                    and not {m.stagedgame.datasource for m in prev} & {m.stagedgame.datasource for m in game}):
+                prev.extend(game)
+                continue
+        earlier.append(game)
+    return [game for games in byteams.values() for game in games]
+
+def reconcile(session, job, rules=DEFAULT_RULES):
+    """Resolves all the staged games of a job. Returns a tuple (resolved, review):
+    resolved is a list of (game, result, stagedgameids) and review a list of
+    review file rows (see write_review).
+
+    Games which a source lists more than once always need review. Games
+    missing from some of the job's sources are resolved from the others,
+    with a comment saying so."""
+    import sources
+    resolved = []
+    review = []
+    games = find_games(session, job, rules)
+    names = sorted({m.stagedgame.datasource for game in games for m in game})
+    sitenames = {name: sources.get_sitename(name) for name in names}
+    seasons = {s.start: s.id for s in session.query(model.Season).filter(
+                    model.Season.start.in_({m.stagedgame.seasonyear for game in games for m in game}))}
+    for game in games:
+        listings = {m.stagedgame.datasource: m for m in game}
+        kind = 'match' if len(listings) > 1 else game[0].stagedgame.datasource
+        if len(listings) < len(game):
+            review.append(_review_row(kind, 'Multiple matches', listings, rules, {}, game))
+            continue
+        missing = [sitenames[name] for name in names if name not in listings]
+        comment = _combine_comments(*['Missing from ' + s for s in missing])
+        g, result, row = resolve(kind, listings, rules, comment,
+                                 seasons.get(game[0].stagedgame.seasonyear))
+        if row is not None:
+            review.append(row)
+        else:
+            resolved.append((g, result, [m.stagedgameid for m in game]))
+    return resolved, review
+
+def _chunks(ids):
+    """Yields lists of at most _CHUNK ids."""
+    ids = list(ids)
+    for i in range(0, len(ids), _CHUNK):
+        yield ids[i:i + _CHUNK]
+
+def _delete_staged(session, stagedgameids):
+    """Deletes staged games and their match keys, in bulk."""
+    for chunk in _chunks(stagedgameids):
+        session.query(model.Match).filter(model.Match.stagedgameid.in_(chunk)
+                                          ).delete(synchronize_session=False)
+        session.query(model.StagedGame).filter(model.StagedGame.id.in_(chunk)
+                                               ).delete(synchronize_session=False)
+
+def _staged_with_keys(session, job, keys):
+    """Returns the ids of a job's staged games with the given match keys,
+    (date, team1id, team2id) tuples."""
+    rows = session.query(model.Match.stagedgameid, model.Match.date,
+                         model.Match.team1id, model.Match.team2id
+                        ).filter(model.Match.jobid == job.id)
+    return [stagedgameid for stagedgameid, date, team1id, team2id in rows
+            if (date, team1id, team2id) in keys]
+
+def _existing_games(session, dates):
+    """Returns a set of (date, hometeamid, awayteamid) for the games already in
+    the database on the given dates."""
+    existing = set()
+    for chunk in _chunks(sorted(set(dates))):
+        existing.update(session.query(model.Game.date, model.Game.hometeamid, model.Game.awayteamid
+                                      ).filter(model.Game.date.in_(chunk)))
+    return existing
+
+def upload(session, resolved):
+    """Adds resolved games (from reconcile) that aren't already in the database
+    and deletes their staged rows, all in one transaction. Existing games are
+    looked up once for all the dates involved. Returns the number of games
+    (inserted, duplicates)."""
+    inserted = 0
+    duplicates = 0
+    try:
+        existing = _existing_games(session, [game.date for game, result, ids in resolved])
+        stagedgameids = []
+        for game, result, ids in resolved:
+            key = (game.date, game.hometeamid, game.awayteamid)
+            flipped = (game.date, game.awayteamid, game.hometeamid)
+            if key in existing or (game.neutralsite and flipped in existing):
+                duplicates += 1
+            else:
+                inserted += 1
+                existing.add(key)
+                session.add(game)
+                session.add(result)
+            stagedgameids.extend(ids)
+        _delete_staged(session, stagedgameids)
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    return inserted, duplicates
+
+def write_review(path, review):
+    """Writes review rows to a csv file. Fill in the homepoints, awaypoints,
+    overtimes and neutralsite columns and set action to 'upload' (or 'skip'),
+    then call apply_review."""
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=REVIEW_FIELDS)
+        writer.writeheader()
+        for row in review:
+            writer.writerow(row)
+
+def read_review(path):
+    """Returns the rows of a review file as a list of dictionaries."""
+    with open(path, newline='') as f:
+        return list(csv.DictReader(f))
+
+def _parse_bool(value):
+    """Parses a neutralsite value from a review file."""
+    value = value.strip().lower()
+    if value in ['1', 'true', 'y', 'yes']:
+        return True
+    if value in ['0', 'false', 'n', 'no']:
+        return False
+    raise ValueError("Not a true/false value: '{}'".format(value))
+
+def apply_review(session, path, job=None):
+    """Uploads the reviewed rows of a review file in one transaction. Rows with
+    action 'upload' are inserted (unless they are duplicates) and rows with
+    action 'skip' are dropped; either way, the job's staged games with the
+    rows' match keys are deleted, so they aren't reconciled again. Rows
+    without an action are written back to the file for later. Returns the
+    number of rows (inserted, duplicates, skipped, pending)."""
+    inserted, duplicates, skipped = 0, 0, 0
+    pending = []
+    keys = set()
+    try:
+        for row in read_review(path):
+            action = (row['action'] or '').strip().lower()
+            if action not in ['upload', 'skip']:
+                pending.append(row)
+                continue
+            if action == 'upload':
+                game = model.Game(date=datetime.datetime.strptime(row['date'], "%Y-%m-%d").date(),
+                                  seasonid=int(row['seasonid']),
+                                  hometeamid=int(row['hometeamid']),
+                                  awayteamid=int(row['awayteamid']),
+                                  neutralsite=_parse_bool(row['neutralsite']),
+                                  comments=row['comments'] or None)
+                result = model.GameResult(homepoints=int(row['homepoints']),
+                                          awaypoints=int(row['awaypoints']),
+                                          overtimes=int(row['overtimes']))
+                result.game = game
+                if not game_is_duplicate(game, session):
+                    inserted += 1
+                    session.add(game)
+                    session.add(result)
+                else:
+                    duplicates += 1
+            else:
+                skipped += 1
+            keys.update(_parse_match_key(k) for k in (row.get('matchkeys') or '').split())
+        if job is not None and len(keys) > 0:
+            _delete_staged(session, _staged_with_keys(session, job, keys))
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    write_review(path, pending)
+    return inserted, duplicates, skipped, len(pending)
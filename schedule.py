@@ -0,0 +1,159 @@
+"""Team schedule and head-to-head lookups, using the teamgame table.
+
+model.TeamGame has one row per team per game, so a team's games are an index
+range scan on (teamid, seasonid, date) or (teamid, opponentid, date), costing
+the number of games the team played, rather than a scan of game for
+hometeamid OR awayteamid. The table is kept in step with game by flush
+listeners (see model._unlink_team_games and model._link_team_games).
+ensure_index() fills it for games uploaded before it existed, and is run by
+main.py's writing commands after creating tables; rebuild() refills it after
+games are changed with bulk statements that bypass the session. Lookups never
+write: schedule() and head_to_head() raise IndexNotBuilt if the table hasn't
+been filled yet (see index_ready).
+"""
+
+import pandas
+from sqlalchemy.sql import select, and_, case, func, literal, union_all
+
+import model
+
+_teamgame = model.TeamGame.__table__
+_game = model.Game.__table__
+_result = model.GameResult.__table__
+_season = model.Season.__table__
+_team = model.Team.__table__
+_opponent = model.Team.__table__.alias('opponent')
+
+_columns = [
+    _teamgame.c.gameid.label('gameid'),
+    _teamgame.c.date.label('date'),
+    _season.c.start.label('season'),
+    _teamgame.c.teamid.label('teamid'),
+    _teamgame.c.opponentid.label('opponentid'),
+    _opponent.c.shortname.label('opponent'),
+    _teamgame.c.home.label('home'),
+    _game.c.neutralsite.label('neutralsite'),
+    case([(_teamgame.c.home == True, _result.c.homepoints)],
+         else_=_result.c.awaypoints).label('points'),
+    case([(_teamgame.c.home == True, _result.c.awaypoints)],
+         else_=_result.c.homepoints).label('opponentpoints'),
+    _result.c.overtimes.label('overtimes'),
+    ]
+
+# Everything else is looked up by primary key, once per game of the team
+_joined = _teamgame.join(
+        _game, _teamgame.c.gameid == _game.c.id
+    ).join(
+        _opponent, _teamgame.c.opponentid == _opponent.c.id
+    ).outerjoin(
+        _result, _teamgame.c.gameid == _result.c.id
+    ).outerjoin(
+        _season, _teamgame.c.seasonid == _season.c.id
+    )
+
+def rebuild(bind):
+    """Refills the teamgame table from the game table, with one statement per
+    side. Returns the number of rows."""
+    rows = []
+    for teamid, opponentid, home in [(_game.c.hometeamid, _game.c.awayteamid, True),
+                                     (_game.c.awayteamid, _game.c.hometeamid, False)]:
+        rows.append(select([teamid.label('teamid'), _game.c.id.label('gameid'),
+                            _game.c.seasonid, _game.c.date,
+                            opponentid.label('opponentid'),
+                            literal(home).label('home')]))
+    bind.execute(_teamgame.delete())
+    bind.execute(_teamgame.insert().from_select(
+            ['teamid', 'gameid', 'seasonid', 'date', 'opponentid', 'home'], union_all(*rows)))
+    return bind.execute(select([func.count()]).select_from(_teamgame)).scalar()
+
+# Databases (by url) whose teamgame table is known to be filled
+_indexed = set()
+
+class IndexNotBuilt(Exception):
+    """Raised by lookups when the teamgame table hasn't been filled."""
+
+
+def _engine(bind):
+    """Returns the engine of a session, connection or engine."""
+    return getattr(bind, 'bind', None) or getattr(bind, 'engine', None) or bind
+
+def index_ready(bind):
+    """Returns True if the teamgame table covers the game table, as far as
+    can be told cheaply: it has rows, or there are no games. Only reads, and
+    once the table has rows it isn't checked again by this process.
+
+    bind - a session, connection or engine"""
+    url = str(_engine(bind).url)
+    if url in _indexed:
+        return True
+    if bind.execute(select([_teamgame.c.gameid]).limit(1)).first() is not None:
+        _indexed.add(url)
+        return True
+    return bind.execute(select([_game.c.id]).limit(1)).first() is None
+
+def ensure_index(engine):
+    """Fills the teamgame table, in its own transaction, if it's empty but the
+    game table isn't, as in databases created before teamgame existed.
+    Returns the number of rows added. For writing commands only; lookups use
+    index_ready.
+
+    engine - an engine"""
+    if index_ready(engine):
+        return 0
+    with engine.begin() as connection:
+        rows = rebuild(connection)
+    _indexed.add(str(engine.url))
+    return rows
+
+def _check_index(bind):
+    """Raises IndexNotBuilt unless the teamgame table is ready."""
+    if not index_ready(bind):
+        raise IndexNotBuilt("The team schedule index is empty. Run 'python main.py reindex' to fill it.")
+
+def team_id(bind, team):
+    """Returns the id of a team given as an id or shortname."""
+    if isinstance(team, int):
+        return team
+    teamid = bind.execute(select([_team.c.id]).where(_team.c.shortname == team)).scalar()
+    if teamid is None:
+        raise ValueError("Unknown team '{}'".format(team))
+    return teamid
+
+def schedule_query(teamid, season=None):
+    """Returns the select used by schedule()."""
+    conditions = [_teamgame.c.teamid == teamid]
+    if season is not None:
+        conditions.append(_season.c.start == season)
+    return select(_columns).select_from(_joined).where(
+                and_(*conditions)).order_by(_teamgame.c.date, _teamgame.c.gameid)
+
+def head_to_head_query(teamid, opponentid):
+    """Returns the select used by head_to_head()."""
+    return select(_columns).select_from(_joined).where(
+                and_(_teamgame.c.teamid == teamid, _teamgame.c.opponentid == opponentid)
+           ).order_by(_teamgame.c.date, _teamgame.c.gameid)
+
+def _frame(bind, query):
+    """Runs a query and returns its rows as a DataFrame."""
+    rows = bind.execute(query).fetchall()
+    return pandas.DataFrame([tuple(r) for r in rows], columns=[c.key for c in _columns])
+
+def schedule(bind, team, season=None):
+    """Returns a pandas DataFrame of a team's games in date order, one row per
+    game from the team's point of view: points are the team's, opponentpoints
+    its opponent's, and home is whether the team was listed at home.
+
+    bind - a session, connection or engine
+    team - a team id or shortname
+    season - the starting year of a season, or None for every season"""
+    _check_index(bind)
+    return _frame(bind, schedule_query(team_id(bind, team), season))
+
+def head_to_head(bind, team, opponent):
+    """Returns a pandas DataFrame of every game between two teams in date
+    order, from the first team's point of view (see schedule).
+
+    bind - a session, connection or engine
+    team, opponent - team ids or shortnames"""
+    _check_index(bind)
+    return _frame(bind, head_to_head_query(team_id(bind, team), team_id(bind, opponent)))
@@ -0,0 +1,355 @@
+"""A long-running scheduler which keeps the database up to date.
+
+It knows the season calendar (see week_dates) and queues a fetch task for
+each source of every week that isn't finished, in source order, then a match
+and upload task once all of them have been fetched. Tasks run one at a time,
+in order of priority:
+    LIVE     - weeks with games today or yesterday, fetched again every
+               live_interval seconds until all their games are final
+    RECENT   - the earlier weeks of the current season
+    BACKFILL - weeks of older seasons, if asked for
+Requests to each host are limited by ratelimit budgets (DEFAULT_BUDGETS), so
+a backfill can run continuously without over-hitting the sources.
+
+The scheduler's state is written to a json status file after every task, and
+can also be served over HTTP (see serve_status): the queue depth by
+priority, how overdue the oldest task of each priority is, the budgets left,
+the latest uploads and errors, and the peak RSS against frames.MEMORY_BUDGET.
+"""
+
+import argparse
+import datetime
+import http.server
+import itertools
+import json
+import os
+import threading
+import time
+
+import journal
+import ratelimit
+import sources
+
+# The season calendar. Week n ends on the Monday n-1 weeks after Labor Day and
+# starts the Tuesday before; week 1 also covers the "week 0" games of late
+# August. Bowl week runs from the end of week 15 into January.
+WEEKS = list(range(1, 16)) + ['Bowl']
+WEEK1_START = (8, 20)
+BOWLS_END = (1, 15)
+
+LIVE, RECENT, BACKFILL = 0, 1, 2
+PRIORITY_NAMES = {LIVE: 'live', RECENT: 'recent', BACKFILL: 'backfill'}
+
+# Requests per period (seconds) for each host
+DEFAULT_BUDGETS = {
+    'www.espn.com': (60, 3600),
+    'stats.ncaa.org': (240, 3600),
+}
+
+# Seconds between fetches of an unfinished week
+LIVE_INTERVAL = 15 * 60
+RECENT_INTERVAL = 6 * 60 * 60
+# Seconds before retrying a failed task
+RETRY_INTERVAL = 30 * 60
+# Seconds between looking at the calendar for new weeks
+PLAN_INTERVAL = 60 * 60
+# How many uploads and errors to show in the status
+HISTORY = 20
+
+def labor_day(year):
+    """Returns the date of Labor Day (the first Monday of September)."""
+    first = datetime.date(year, 9, 1)
+    return first + datetime.timedelta(days=(7 - first.weekday()) % 7)
+
+def week_dates(season, week):
+    """Returns the first and last dates of a week of the season.
+
+    season - the season's starting year
+    week - a number (1-15) or 'Bowl'"""
+    if week == 'Bowl':
+        first = week_dates(season, 15)[1] + datetime.timedelta(days=1)
+        return first, datetime.date(season + 1, *BOWLS_END)
+    last = labor_day(season) + datetime.timedelta(weeks=week - 1)
+    if week == 1:
+        return datetime.date(season, *WEEK1_START), last
+    return last - datetime.timedelta(days=6), last
+
+def season_of(date):
+    """Returns the season a date belongs to."""
+    return date.year if date.month >= 7 else date.year - 1
+
+def week_priority(season, week, today):
+    """Returns the priority of a week's tasks on the given day."""
+    first, last = week_dates(season, week)
+    if first <= today <= last + datetime.timedelta(days=1):
+        return LIVE
+    if season == season_of(today):
+        return RECENT
+    return BACKFILL
+
+def game_dates(games):
+    """Returns the sorted dates of a dictionary of DataFrames of games."""
+    return sorted({d.date() for df in games.values() if 'Date' in df for d in df['Date']})
+
+
+class Task:
+    """A unit of work: fetching one source's games for a week ('fetch'), or
+    matching and uploading a week ('upload')."""
+
+    def __init__(self, kind, season, week, priority, due, source=None):
+        self.kind = kind
+        self.season = season
+        self.week = week
+        self.priority = priority
+        self.due = due
+        self.source = source
+
+    def as_dict(self):
+        """Returns the task as a json-friendly dictionary."""
+        return {'kind': self.kind, 'season': self.season, 'week': str(self.week),
+                'source': self.source, 'priority': PRIORITY_NAMES[self.priority],
+                'due': self.due.isoformat(timespec='seconds')}
+
+    def __repr__(self):
+        return "<Task(kind='{}', season='{}', week='{}', source='{}', priority='{}', due='{}')>".format(
+                self.kind, self.season, self.week, self.source, self.priority, self.due)
+
+
+class Scheduler:
+    """Plans and runs the tasks keeping the database up to date.
+
+    session - a database session
+    sourcenames - the datasources to fetch, in order (default sources.DEFAULT_SOURCES)
+    cachedir - the directory for cached pages and review files
+    backfill - older seasons to fill in, at low priority
+    budgets - a dictionary of host: (requests, seconds), see ratelimit
+    statusfile - where to write the status json, or None
+    workers - how many pages a source may fetch at once
+    checks - data-quality check severities, see validate.get_severity
+    clock - a function returning the current datetime"""
+
+    def __init__(self, session, sourcenames=None, cachedir='cache', backfill=(),
+                 budgets=DEFAULT_BUDGETS, statusfile=None, workers=1, checks=None,
+                 live_interval=LIVE_INTERVAL, recent_interval=RECENT_INTERVAL,
+                 retry_interval=RETRY_INTERVAL, plan_interval=PLAN_INTERVAL,
+                 clock=datetime.datetime.now):
+        self.session = session
+        self.sourcenames = list(sources.DEFAULT_SOURCES if sourcenames is None else sourcenames)
+        self.cachedir = cachedir
+        self.backfill = list(backfill)
+        self.statusfile = statusfile
+        self.workers = workers
+        self.checks = checks
+        self.live_interval = live_interval
+        self.recent_interval = recent_interval
+        self.retry_interval = retry_interval
+        self.plan_interval = plan_interval
+        self.clock = clock
+        for host, (requests, period) in budgets.items():
+            ratelimit.set_budget(host, requests, period)
+        self.queue = []
+        self.lock = threading.Lock()
+        self.order = itertools.count()
+        # Games fetched so far for each (season, week), by datasource
+        self.games = {}
+        self.running = None
+        self.started = clock()
+        self.planned = None
+        self.uploads = []
+        self.errors = []
+
+    def enqueue(self, task):
+        """Adds a task to the queue."""
+        with self.lock:
+            self.queue.append((next(self.order), task))
+
+    def queued(self, season, week):
+        """Returns True if there are tasks queued for the week."""
+        with self.lock:
+            return any(t.season == season and str(t.week) == str(week) for _, t in self.queue)
+
+    def plan(self):
+        """Queues the first fetch of every started week that isn't finished
+        or already queued."""
+        now = self.clock()
+        today = now.date()
+        for season in [season_of(today)] + self.backfill:
+            for week in WEEKS:
+                if week_dates(season, week)[0] > today:
+                    continue
+                if self.queued(season, week) or journal.is_done(self.session, 'uploaded',
+                                                                'scheduler', season, week):
+                    continue
+                self.enqueue(Task('fetch', season, week, week_priority(season, week, today),
+                                  now, self.sourcenames[0]))
+        self.planned = now
+
+    def next_task(self):
+        """Removes and returns the most urgent task which is due, or None."""
+        now = self.clock()
+        with self.lock:
+            ready = [(t.priority, t.due, n, t) for n, t in self.queue if t.due <= now]
+            if len(ready) == 0:
+                return None
+            n, task = min(ready, key=lambda item: item[:3])[2:]
+            self.queue.remove((n, task))
+            return task
+
+    def run_fetch(self, task):
+        """Fetches one source's games for a week, then queues the next source,
+        or the upload once every source has been fetched."""
+        source = sources.get_source(task.source)
+        games = self.games.setdefault((task.season, task.week), {})
+        dates = game_dates(games) if len(games) > 0 else None
+        games[task.source] = source.fetch(task.season, task.week, self.session, self.cachedir,
+                                          dates=dates, echo=True, workers=self.workers)
+        index = self.sourcenames.index(task.source)
+        now = self.clock()
+        if index + 1 < len(self.sourcenames):
+            self.enqueue(Task('fetch', task.season, task.week, task.priority, now,
+                              self.sourcenames[index + 1]))
+        else:
+            self.enqueue(Task('upload', task.season, task.week, task.priority, now))
+
+    def run_upload(self, task):
+        """Matches and uploads a week without prompting, using the games just
+        fetched. If any source still has unfinished games, the week is
+        fetched again later; otherwise it's done."""
+        import main
+        games = self.games.pop((task.season, task.week), None)
+        if games is None or set(games) != set(self.sourcenames):
+            games = main.get_games(task.season, task.week, self.session,
+                                   sources.get_sources(self.sourcenames),
+                                   cachedir=self.cachedir, echo=True, workers=self.workers)
+        args = argparse.Namespace(season=task.season, week=task.week, cachedir=self.cachedir,
+                                  workers=self.workers, sources=self.sourcenames,
+                                  checks=self.checks, no_input=True, yes=True)
+        # Always stage afresh, since the games may have changed since last time
+        journal.forget(self.session, task.season, task.week, ['staged', 'matched'])
+        job = main.cmd_match(args, self.session, games)
+        main.cmd_upload(args, self.session, job)
+        dates = game_dates(games)
+        complete = all(sources.get_source(name).fetched(self.session, task.season, task.week, dates)
+                       for name in self.sourcenames)
+        now = self.clock()
+        with self.lock:
+            self.uploads = ([{'season': task.season, 'week': str(task.week),
+                              'time': now.isoformat(timespec='seconds'), 'complete': complete}]
+                            + self.uploads)[:HISTORY]
+        if complete:
+            journal.mark_done(self.session, 'uploaded', 'scheduler', task.season, task.week)
+        else:
+            interval = self.live_interval if task.priority == LIVE else self.recent_interval
+            self.enqueue(Task('fetch', task.season, task.week,
+                              week_priority(task.season, task.week, now.date()),
+                              now + datetime.timedelta(seconds=interval), self.sourcenames[0]))
+
+    def run_task(self, task):
+        """Runs a task. A task which fails is retried after retry_interval."""
+        with self.lock:
+            self.running = task
+        try:
+            if task.kind == 'fetch':
+                self.run_fetch(task)
+            else:
+                self.run_upload(task)
+        except Exception as e:
+            self.session.rollback()
+            now = self.clock()
+            with self.lock:
+                self.errors = ([dict(task.as_dict(), time=now.isoformat(timespec='seconds'),
+                                     error=repr(e))] + self.errors)[:HISTORY]
+            task.due = now + datetime.timedelta(seconds=self.retry_interval)
+            self.enqueue(task)
+        finally:
+            with self.lock:
+                self.running = None
+
+    def status(self):
+        """Returns the scheduler's status as a json-friendly dictionary."""
+        import frames
+        now = self.clock()
+        with self.lock:
+            tasks = sorted((t for _, t in self.queue), key=lambda t: (t.priority, t.due))
+            depth = {name: 0 for name in PRIORITY_NAMES.values()}
+            lag = {name: 0 for name in PRIORITY_NAMES.values()}
+            for t in tasks:
+                name = PRIORITY_NAMES[t.priority]
+                depth[name] += 1
+                if t.due <= now:
+                    lag[name] = max(lag[name], int((now - t.due).total_seconds()))
+            return {
+                'time': now.isoformat(timespec='seconds'),
+                'started': self.started.isoformat(timespec='seconds'),
+                'planned': None if self.planned is None else self.planned.isoformat(timespec='seconds'),
+                'running': None if self.running is None else self.running.as_dict(),
+                'queue_depth': len(tasks),
+                'queue_depth_by_priority': depth,
+                'lag_seconds_by_priority': lag,
+                'queue': [t.as_dict() for t in tasks[:HISTORY]],
+                'budgets': {host: {'available': b.available(), 'used': b.used,
+                                   'requests': b.requests, 'period': b.period}
+                            for host, b in ratelimit.BUDGETS.items()},
+                'uploads': list(self.uploads),
+                'errors': list(self.errors),
+                'peak_rss': frames.peak_rss(),
+                'memory_budget': frames.MEMORY_BUDGET,
+                }
+
+    def write_status(self):
+        """Writes the status to statusfile, if there is one, replacing it in
+        one step so readers never see half a file."""
+        if self.statusfile is None:
+            return
+        directory = os.path.dirname(self.statusfile)
+        if directory != '':
+            os.makedirs(directory, exist_ok=True)
+        temp = self.statusfile + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(self.status(), f, indent=2)
+        os.replace(temp, self.statusfile)
+
+    def run(self, stop=None, poll=60):
+        """Plans and runs tasks until stop (a threading.Event) is set. When
+        nothing is due, sleeps until the next task is due, for at most poll
+        seconds."""
+        while stop is None or not stop.is_set():
+            now = self.clock()
+            if self.planned is None or (now - self.planned).total_seconds() >= self.plan_interval:
+                self.plan()
+            task = self.next_task()
+            if task is not None:
+                self.run_task(task)
+                self.write_status()
+                continue
+            self.write_status()
+            with self.lock:
+                dues = [t.due for _, t in self.queue]
+            wait = poll if len(dues) == 0 else min(poll, max(1, (min(dues) - now).total_seconds()))
+            if stop is None:
+                time.sleep(wait)
+            else:
+                stop.wait(wait)
+
+
+def serve_status(scheduler, host='127.0.0.1', port=0):
+    """Serves the scheduler's status as json over HTTP from a background
+    thread, and returns the server. Port 0 picks any free port."""
+    class StatusHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(scheduler.status(), indent=2).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Don't print every request
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), StatusHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,146 @@
+"""Pluggable sources of game scores.
+
+A source is a module with a SOURCE attribute, an instance of a Source
+subclass, which knows how to fetch a week of games as a pandas DataFrame with
+the columns Home, Away, HomePoints, AwayPoints, Date, Season and Comments,
+and optionally Status, Overtimes and NeutralSite. Its games are staged in
+model.StagedGame under its datasource name, the same name used for its team
+names in the sourceteamname table.
+
+espn and ncaa are the built-in sources. Others are registered with register,
+or by listing them in the CFB_SOURCES environment variable as
+datasource=module pairs separated by commas, e.g.
+    CFB_SOURCES=sports-reference.com=sportsref
+Modules are only imported when their source is used, so listing a source
+doesn't slow down commands that don't fetch anything.
+"""
+
+import collections
+import datetime
+import importlib
+import os
+
+import journal
+
+# Datasource name: module, in the order sources are fetched and listed
+PLUGINS = collections.OrderedDict([
+    ('espn.com', 'espn'),
+    ('ncaa.org', 'ncaa'),
+    ])
+
+DEFAULT_SOURCES = ['espn.com', 'ncaa.org']
+
+# Datasource name: the name used in game comments (a Source's sitename), kept
+# here so that naming a source doesn't import its module and scraper
+# dependencies. Sources not listed are named by their datasource name.
+SITENAMES = {
+    'espn.com': 'ESPN.com',
+    'ncaa.org': 'NCAA.org',
+    }
+
+# Games more than this many days old won't change any more: any still without
+# a score or final status (e.g. canceled games) are journaled as they are and
+# left to validation, rather than fetched again forever
+PENDING_DAYS = 1
+
+def pending_cutoff():
+    """Returns the earliest date on which unfinished games may still finish."""
+    return datetime.date.today() - datetime.timedelta(days=PENDING_DAYS)
+
+class Source:
+    """The interface of a source of games. Subclasses set name, label and
+    sitename, and implement fetch and fetched."""
+
+    # The datasource name, as in sourceteamname
+    name = None
+    # A short name for messages and file names, e.g. 'ESPN'
+    label = None
+    # The name used in game comments, e.g. 'Missing from ESPN.com' (see SITENAMES)
+    sitename = None
+
+    def fetch(self, season, week, session, cachedir, dates=None, echo=True, workers=1):
+        """Returns a pandas DataFrame of the games of the given week. Sources
+        should cache what they fetch in cachedir and record it in the journal
+        (see read_cached_unit and cache_unit) so that it isn't fetched twice.
+
+        season - the season's starting year
+        week - a number (1-15) or 'B' for bowls
+        session - a database session, for the journal
+        cachedir - a directory for cached pages
+        dates - the dates of the games found by the sources fetched before
+            this one, for sources which can only be fetched by date, or None
+        echo - whether to print progress
+        workers - how many pages the source may fetch at once"""
+        raise NotImplementedError
+
+    def fetched(self, session, season, week, dates=None):
+        """Returns True if all of the week's games have been fetched and
+        journaled, so that fetch would only read the cache. Arguments are as
+        for fetch."""
+        raise NotImplementedError
+
+    def __repr__(self):
+        return "<Source(name='{}')>".format(self.name)
+
+
+def register(name, module, sitename=None):
+    """Registers the module with the given name as the source of datasource
+    name. The module must have a SOURCE attribute. sitename is the name used
+    in game comments, if not the datasource name."""
+    PLUGINS[name] = module
+    if sitename is not None:
+        SITENAMES[name] = sitename
+
+def get_sitename(name):
+    """Returns the name used in game comments for a datasource, without
+    importing its module."""
+    return SITENAMES.get(name, name)
+
+def _register_from_environment():
+    """Registers the sources listed in the CFB_SOURCES environment variable."""
+    for item in os.environ.get('CFB_SOURCES', '').split(','):
+        if item.strip() == '':
+            continue
+        name, _, module = item.partition('=')
+        register(name.strip(), module.strip())
+
+_register_from_environment()
+
+def get_source(name):
+    """Returns the Source registered for a datasource name, importing its
+    module if needed."""
+    if name not in PLUGINS:
+        raise KeyError("Unknown source '{}'. Known sources: {}".format(name, ", ".join(PLUGINS)))
+    return importlib.import_module(PLUGINS[name]).SOURCE
+
+def get_sources(names=None):
+    """Returns the Sources for a list of datasource names (by default
+    DEFAULT_SOURCES), in order."""
+    return [get_source(name) for name in (DEFAULT_SOURCES if names is None else names)]
+
+def read_cached_unit(session, cachedir, filename, source, season, week, division=None, date=None):
+    """Reads a cached unit of games, if the journal says it was fetched.
+    Returns None if the unit needs to be fetched again."""
+    import pandas
+    import frames
+    entry = journal.get_entry(session, 'fetched', source, season, week, division, date)
+    if entry is None:
+        return None
+    if entry.rows == 0:
+        return pandas.DataFrame([])
+    path = os.path.join(cachedir, filename)
+    if not os.path.exists(path):
+        return None
+    return frames.read_games_csv(path)
+
+def cache_unit(games, session, cachedir, filename, source, season, week, division=None, date=None,
+               complete=True):
+    """Caches a fetched unit of games and records it in the journal. Units with
+    games that haven't finished yet (complete=False) are cached but not
+    journaled, so they're fetched again next time."""
+    rows = 0 if games is None else len(games)
+    if rows > 0:
+        os.makedirs(cachedir, exist_ok=True)
+        games.to_csv(os.path.join(cachedir, filename), index=False)
+    if complete:
+        journal.mark_done(session, 'fetched', source, season, week, division, date, rows=rows)
@@ -0,0 +1,244 @@
+"""Data-quality checks run on scraped games before they are staged, and on
+staged games before they are uploaded.
+
+Each check is vectorized over a whole DataFrame and returns a boolean mask of
+the offending rows. The severity of each check (see DEFAULT_SEVERITY) decides
+what happens to those rows:
+    'error'   - the rows are quarantined (left out of staging)
+    'warning' - the rows are kept, but reported
+    'ignore'  - the check isn't run
+except that rows which can't be staged at all (see UNSTAGEABLE), such as
+games without a score, are always quarantined.
+validate_games returns the good rows, the quarantined rows and a report, a
+list of dictionaries which write_report saves as json.
+
+Severities can be changed without editing DEFAULT_SEVERITY, by the
+CFB_VALIDATION environment variable (check=level pairs separated by commas)
+or the --check option of main.py, e.g.
+    CFB_VALIDATION=team_twice_in_day=error,date_out_of_season=warning
+See get_severity.
+"""
+
+import datetime
+import json
+import os
+
+import numpy
+import pandas
+from sqlalchemy.sql import select, func, union_all
+
+import model
+
+DEFAULT_SEVERITY = {
+    'missing_team': 'error',
+    'same_team': 'error',
+    'missing_score': 'error',
+    'negative_score': 'error',
+    'date_out_of_season': 'error',
+    'duplicate_game': 'error',
+    'team_twice_in_day': 'warning',
+    }
+
+LEVELS = ['error', 'warning', 'ignore']
+
+# Regular season games start in August, bowls end in January
+SEASON_START = (8, 1)
+SEASON_END = (1, 31)
+
+# How many offending rows to include in the report for each check
+SAMPLE_SIZE = 5
+
+def _text(column):
+    """Returns a column as plain strings, with missing values as ''."""
+    return column.astype(object).where(column.notna(), '').astype(str).str.strip()
+
+def _prepare(games):
+    """Returns the columns the checks need, converted once: team names as
+    plain strings and dates as datetime64."""
+    return pandas.DataFrame({
+        'Home': _text(games['Home']),
+        'Away': _text(games['Away']),
+        'HomePoints': games['HomePoints'],
+        'AwayPoints': games['AwayPoints'],
+        'Date': pandas.to_datetime(games['Date']),
+        }, index=games.index)
+
+# Each check takes the output of _prepare and the season's starting year
+
+def check_missing_team(games, season):
+    """Games without a home or away team name."""
+    return (games['Home'] == '') | (games['Away'] == '')
+
+def check_same_team(games, season):
+    """Games where a team plays itself."""
+    return (games['Home'] != '') & (games['Home'] == games['Away'])
+
+def check_missing_score(games, season):
+    """Games without a home or away score."""
+    return games['HomePoints'].isna() | games['AwayPoints'].isna()
+
+def check_negative_score(games, season):
+    """Games with a negative score."""
+    return (games['HomePoints'] < 0).fillna(False) | (games['AwayPoints'] < 0).fillna(False)
+
+def check_date_out_of_season(games, season):
+    """Games dated outside the season, e.g. from a wrong guess of the year
+    when ESPN only shows a month and day."""
+    start = pandas.Timestamp(datetime.date(season, *SEASON_START))
+    end = pandas.Timestamp(datetime.date(season + 1, *SEASON_END))
+    dates = games['Date']
+    return dates.isna() | (dates < start) | (dates > end)
+
+def check_duplicate_game(games, season):
+    """Games listed more than once on the same date, with either team at home.
+    The first listing is not flagged."""
+    home = games['Home'].values
+    away = games['Away'].values
+    pairs = pandas.DataFrame({'Date': games['Date'].values,
+                              'Team1': numpy.where(home < away, home, away),
+                              'Team2': numpy.where(home < away, away, home)},
+                             index=games.index)
+    return pairs.duplicated(keep='first')
+
+def check_team_twice_in_day(games, season):
+    """Different games on the same date involving the same team."""
+    n = len(games)
+    dates = games['Date'].values
+    teams = pandas.DataFrame({'Date': numpy.concatenate([dates, dates]),
+                              'Team': numpy.concatenate([games['Home'].values,
+                                                         games['Away'].values])})
+    twice = teams.duplicated(keep=False).values
+    # Exact duplicates are check_duplicate_game's job
+    return pandas.Series(twice[:n] | twice[n:], index=games.index) & ~check_duplicate_game(games, season)
+
+CHECKS = {
+    'missing_team': check_missing_team,
+    'same_team': check_same_team,
+    'missing_score': check_missing_score,
+    'negative_score': check_negative_score,
+    'date_out_of_season': check_date_out_of_season,
+    'duplicate_game': check_duplicate_game,
+    'team_twice_in_day': check_team_twice_in_day,
+    }
+
+# The rows of a check which stagedgame's NOT NULL columns can't take, and
+# which are quarantined even when the check's severity is lowered. Only games
+# without a date are out of date_out_of_season.
+UNSTAGEABLE = {
+    'missing_team': check_missing_team,
+    'missing_score': check_missing_score,
+    'date_out_of_season': lambda games, season: games['Date'].isna(),
+    }
+
+def get_severity(overrides=None):
+    """Returns the severity of each check: DEFAULT_SEVERITY, changed by the
+    CFB_VALIDATION environment variable and then by overrides. Raises
+    ValueError for unknown checks or levels.
+
+    overrides - a dictionary or list of (check name, level) pairs"""
+    pairs = []
+    for item in os.environ.get('CFB_VALIDATION', '').split(','):
+        if item.strip() == '':
+            continue
+        name, _, level = item.partition('=')
+        pairs.append((name.strip(), level.strip()))
+    pairs.extend(dict(overrides or {}).items())
+    severity = dict(DEFAULT_SEVERITY)
+    for name, level in pairs:
+        if name not in CHECKS:
+            raise ValueError("Unknown check '{}'. Checks: {}".format(name, ", ".join(CHECKS)))
+        if level not in LEVELS:
+            raise ValueError("Severity must be one of {}, not '{}'".format(", ".join(LEVELS), level))
+        severity[name] = level
+    return severity
+
+def _sample(games, mask):
+    """Returns a few of the offending rows, as json-friendly dictionaries."""
+    sample = games[mask].head(SAMPLE_SIZE)
+    return json.loads(sample.to_json(orient='records', date_format='iso'))
+
+def validate_games(games, season, source, severity=DEFAULT_SEVERITY):
+    """Runs all checks on a DataFrame of scraped games. Returns a tuple
+    (good, quarantined, report): the rows which passed every 'error' check,
+    the rows which didn't (with a 'Check' column naming the first failed
+    check), and a list of report entries.
+
+    games - a pandas DataFrame from espn or ncaa
+    season - the season's starting year
+    source - a name for the games in the report, e.g. 'espn.com'
+    severity - a dictionary of check name: 'error', 'warning' or 'ignore'"""
+    report = []
+    failed = pandas.Series(None, index=games.index, dtype=object)
+    if len(games) == 0:
+        return games, games.assign(Check=failed), report
+    prepared = _prepare(games)
+    for name, check in CHECKS.items():
+        level = severity.get(name, 'error')
+        nomask = pandas.Series(False, index=games.index)
+        mask = nomask if level == 'ignore' else check(prepared, season).fillna(False).astype(bool)
+        # Rows which can't be staged are errors, whatever the severity
+        forced = nomask
+        if level != 'error' and name in UNSTAGEABLE:
+            forced = UNSTAGEABLE[name](prepared, season).fillna(False).astype(bool)
+        for entrylevel, rows in [('error', forced), (level, mask & ~forced)]:
+            count = int(rows.sum())
+            if count == 0:
+                continue
+            report.append({'check': name, 'severity': entrylevel, 'source': source,
+                           'season': season, 'rows': count,
+                           'sample': _sample(games, rows)})
+            if entrylevel == 'error':
+                failed[rows & failed.isna()] = name
+    bad = failed.notna()
+    quarantined = games[bad].assign(Check=failed[bad])
+    return games[~bad], quarantined, report
+
+def _iso(value):
+    """Returns a date from the database as an iso format string."""
+    return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+
+def validate_staged(session, job, severity=DEFAULT_SEVERITY):
+    """Checks a job's staged games in the database, with one aggregate query
+    per check covering every source. Returns a list of report entries;
+    nothing is quarantined."""
+    report = []
+    table = model.StagedGame.__table__
+    if severity.get('duplicate_game', 'error') != 'ignore':
+        dupes = select([table.c.datasource, table.c.date, table.c.home, table.c.away,
+                        func.count().label('n')]
+                    ).where(table.c.jobid == job.id
+                    ).group_by(table.c.datasource, table.c.date, table.c.home, table.c.away
+                    ).having(func.count() > 1)
+        report.extend(_staged_entries('duplicate_game', severity.get('duplicate_game', 'error'), job,
+                                      session.execute(dupes).fetchall(),
+                                      lambda r: {'date': _iso(r[1]), 'home': r[2], 'away': r[3],
+                                                 'count': r[4]}))
+    if severity.get('team_twice_in_day', 'warning') != 'ignore':
+        teams = union_all(
+                    select([table.c.datasource, table.c.date, table.c.home.label('team')]
+                          ).where(table.c.jobid == job.id),
+                    select([table.c.datasource, table.c.date, table.c.away.label('team')]
+                          ).where(table.c.jobid == job.id)
+                ).alias('teams')
+        twice = select([teams.c.datasource, teams.c.date, teams.c.team, func.count().label('n')]
+                    ).group_by(teams.c.datasource, teams.c.date, teams.c.team
+                    ).having(func.count() > 1)
+        report.extend(_staged_entries('team_twice_in_day', severity.get('team_twice_in_day', 'warning'), job,
+                                      session.execute(twice).fetchall(),
+                                      lambda r: {'date': _iso(r[1]), 'team': r[2], 'count': r[3]}))
+    return report
+
+def _staged_entries(check, level, job, rows, sample):
+    """Returns one report entry per datasource for the offending rows of an
+    aggregate check, whose first column is the datasource."""
+    bysource = {}
+    for r in rows:
+        bysource.setdefault(r[0], []).append(r)
+    return [{'check': check, 'severity': level, 'source': source, 'season': job.seasonyear,
+             'rows': len(found), 'sample': [sample(r) for r in found[:SAMPLE_SIZE]]}
+            for source, found in sorted(bysource.items())]
+
+def write_report(path, report):
+    """Writes a validation report to a json file."""
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)